@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+GPL = """
+Streaming reader for pyrunlim and pyrunner logs.
+Copyright (C) 2014-2018  Mario Alviano (mario@alviano.net)
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import json
+import sys
+import xml.etree.ElementTree as etree
+
+COLUMNS = ["real", "user", "sys", "max-memory", "rss", "swap", "read", "write"]
+CONTEXT = ["benchmark", "testcase", "command"]
+STRINGS = ["version", "job", "cpu-affinity", "pyrunlim-cpu-affinity"]
+
+def convert(value):
+    if value == "None":
+        return None
+    try:
+        # missing limits are written as 10**100 in xml logs, and as null in jsonl logs
+        res = int(value)
+        return res if res < 10**100 else None
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def attributes(element):
+    return {key: value if key in STRINGS else convert(value) for (key, value) in element.attrib.items()}
+
+def text(element):
+    # long text is split in several <long-text> elements
+    return "".join(element.itertext())
+
+class JsonReader:
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        self.buffer += data
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line.startswith("{"):
+                yield json.loads(line)
+
+    def close(self):
+        line = self.buffer.strip()
+        self.buffer = ""
+        if line.startswith("{"):
+            yield json.loads(line)
+
+class XmlReader:
+    def __init__(self):
+        self.parser = etree.XMLPullParser(events=("start", "end"))
+        self.stack = []
+        self.context = {}
+
+    def feed(self, data):
+        self.parser.feed(data)
+        return self._events()
+
+    def close(self):
+        self.parser.close()
+        return self._events()
+
+    def _events(self):
+        for (event, element) in self.parser.read_events():
+            if event == "start":
+                self.stack.append(element)
+                if element.tag == "pyrunlim":
+                    record = {"type": "begin"}
+                    record.update(self.context)
+                    record.update(attributes(element))
+                    record["columns"] = COLUMNS
+                    yield record
+                elif element.tag in CONTEXT:
+                    self.context[element.tag] = element.get("id")
+                continue
+
+            self.stack.pop()
+            record = self._record(element)
+            if record != None:
+                yield record
+            if element.tag in CONTEXT:
+                del self.context[element.tag]
+            # only the elements of the current record are kept in memory
+            if element.tag in ("sample", "stream", "stats", "validator", "skip") or element.tag in CONTEXT or element.tag == "pyrunlim":
+                element.clear()
+                if self.stack:
+                    self.stack[-1].remove(element)
+
+    def _record(self, element):
+        if element.tag == "sample" and self.stack and self.stack[-1].tag == "pyrunlim":
+            return {"type": "sample", "sample": [convert(element.get(key)) for key in COLUMNS if key in element.attrib]}
+        if element.tag == "stream":
+            record = {"type": element.get("type"), "real": convert(element.get("real"))}
+            if "bytes" in element.attrib:
+                record["bytes"] = int(element.get("bytes"))
+            sample = element.find("last-sample")
+            if sample != None:
+                record["sample"] = [convert(sample.get(key)) for key in COLUMNS if key in sample.attrib]
+            line = element.find("line")
+            if line != None:
+                record["line"] = text(line)
+            matches = [{"regex": text(match.find("regex")), "groups": {group.get("name"): text(group) for group in match.findall("group")}} for match in element.findall("match")]
+            if matches:
+                record["matches"] = matches
+            return record
+        if element.tag == "stats":
+            record = {"type": "stats"}
+            record.update(self.context)
+            record.update(attributes(element))
+            regexes = element.findall("regex")
+            if regexes:
+                record["regex-hits"] = [{"regex": text(regex), "hits": int(regex.get("hits"))} for regex in regexes]
+            return record
+        if element.tag == "validator":
+            record = {"type": "validator"}
+            record.update(self.context)
+            record["response"] = element.get("response")
+            return record
+        if element.tag == "skip":
+            record = {"type": "skip"}
+            record.update(self.context)
+            return record
+        return None
+
+def records(stream, size=65536):
+    reader = None
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        if reader == None:
+            stripped = data.lstrip()
+            if not stripped:
+                continue
+            reader = JsonReader() if stripped.startswith("{") else XmlReader()
+        yield from reader.feed(data)
+    if reader != None:
+        yield from reader.close()
+
+def summaries(stream):
+    current = None
+    for record in records(stream):
+        if record["type"] == "begin":
+            current = {"begin": record, "matches": []}
+        elif current == None:
+            continue
+        elif record["type"] in ("stdout", "stderr"):
+            for match in record.get("matches", []):
+                current["matches"].append(dict(match, real=record["real"]))
+        elif record["type"] == "stats":
+            current["stats"] = record
+            yield current
+            current = None
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Read pyrunlim (xml or jsonl) and pyrunner logs incrementally, and print one JSON summary per run.")
+    parser.add_argument('log', metavar='<log>', type=str, nargs='?', default="-", help='log file to read (default is stdin)')
+    parser.add_argument('-r', '--records', action='store_true', help='print every record rather than one summary per run')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parseArguments()
+    stream = sys.stdin if args.log == "-" else open(args.log)
+    for item in (records(stream) if args.records else summaries(stream)):
+        print(json.dumps(item, separators=(",", ":")))
@@ -20,65 +20,189 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 VERSION = "2.18"
 
+import time
+START_TIME = time.perf_counter()
+
 import argparse
-import psutil
+import array
+import atexit
+import codecs
+import collections
+import copy
+import ctypes
+import heapq
+import json
 import os
 import re
+import resource
+import select
+import selectors
 import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
-import time
 import threading
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
 
-def parseArguments(process):
+# modules needed only by some options (psutil, csv, tempfile, ...) are imported where used,
+# so that short runs only pay for what they use (see --self-benchmark)
+IMPORT_TIME = time.perf_counter() - START_TIME
+
+class JobParser(argparse.ArgumentParser):
+    # options of the jobs of --batch: errors are reported with the line of the job
+    def error(self, message):
+        raise ValueError(message)
+
+def argumentParser(cls=argparse.ArgumentParser):
     global VERSION
     global GPL
-    parser = argparse.ArgumentParser(description=GPL.split("\n")[1], epilog="Copyright (C) 2014  Mario Alviano (mario@alviano.net)")
+    parser = cls(description=GPL.split("\n")[1], epilog="Copyright (C) 2014  Mario Alviano (mario@alviano.net)")
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + VERSION, help='print version number')
     parser.add_argument('-t', '--time', metavar='<integer>', type=int, help='set time (user+sys) limit to <integer> seconds')
     parser.add_argument('-m', '--memory', metavar='<integer>', type=int, help='set memory (rss+swap) limit to <integer> MB')
     parser.add_argument('-r', '--realtime', metavar='<integer>', type=int, help='set real time limit to <integer> seconds')
     parser.add_argument('-s', '--swap', metavar='<integer>', type=int, help='set swap limit to <integer> MB')
+    parser.add_argument('--io', action='store_true', help='account the data read and written by the command (rchar and wchar of /proc/<pid>/io, i.e., from and to files, pipes and sockets) and its open files, and report them in samples and stats (implied by --io-read-limit and --io-write-limit)')
+    parser.add_argument('--io-read-limit', metavar='<integer>', type=int, help='set limit on the data read by the command (from files, pipes and sockets) to <integer> MB')
+    parser.add_argument('--io-write-limit', metavar='<integer>', type=int, help='set limit on the data written by the command (to files, pipes and sockets) to <integer> MB')
+    parser.add_argument('--soft-time', metavar='<integer>', type=int, help='set soft time (user+sys) limit to <integer> seconds: when reached, the command is sent --grace-signal, and killed after --grace seconds (or at the hard limit, if reached before)')
+    parser.add_argument('--soft-memory', metavar='<integer>', type=int, help='set soft memory (rss+swap) limit to <integer> MB (see --soft-time)')
+    parser.add_argument('--soft-realtime', metavar='<integer>', type=int, help='set soft real time limit to <integer> seconds (see --soft-time)')
+    parser.add_argument('--grace-signal', metavar='<signal>', type=parseSignal, help='signal sent to the processes of the command at a soft limit, by name or number (default is TERM)')
+    parser.add_argument('--grace', metavar='<float>', type=float, help='seconds given to the command to terminate after a soft limit (default is 10)')
+    parser.add_argument('--kernel-limits', action='store_true', help='also let the kernel enforce time and memory limits on each process of the command, by means of RLIMIT_CPU (SIGXCPU at the limit, SIGKILL one second later) and RLIMIT_DATA (or RLIMIT_AS, see --kernel-memory-limit)')
+    parser.add_argument('--kernel-memory-limit', metavar='<rlimit>', type=str, choices=['data', 'as'], help='rlimit used by --kernel-limits for the memory limit (data, i.e., RLIMIT_DATA, or as, i.e., RLIMIT_AS; default is data)')
+    parser.add_argument('--sampling', metavar='<sampling>', type=str, choices=['fixed', 'adaptive'], default='fixed', help='sampling schedule (fixed, i.e., every 0.1, 0.2, 0.5 and then 1 seconds, or adaptive, i.e., more often when usage is close to or quickly approaching a limit, down to every 0.01 seconds, and less often when it is flat, up to every 2 seconds; default is fixed)')
+    parser.add_argument('--perf', action='store_true', help='count instructions, cycles, last level cache misses and context switches of the command by means of perf_event_open, and report them in stats (counters not allowed by perf_event_paranoid or not supported are omitted; user space only if kernel space is not allowed)')
+    parser.add_argument('--direct', action='store_true', help='run <command> directly rather than by means of bash -c, if it contains no pipes, redirections or other shell syntax (SIGINT and SIGTERM are ignored and PYTHONHASHSEED is 0 as with bash)')
+    parser.add_argument('--calibrate', metavar='<integer>', type=int, help='measure the cost of running true by means of bash -c and directly, averaged over <integer> runs, save it in the calibration file, and exit (the overhead of bash -c is the difference)')
+    parser.add_argument('--calibration-file', metavar='<filename>', type=str, help='calibration file (default is $XDG_CACHE_HOME/pyrunlim/calibration.json, or ~/.cache/pyrunlim/calibration.json); if it has a calibration for this host, stats also report times corrected by the overhead of running the command')
+    parser.add_argument('--metrics-socket', metavar='<filename>', type=str, help='serve the last sample of the command on the unix domain socket <filename> while it runs; every connection receives one snapshot (see --metrics-format) and is closed')
+    parser.add_argument('--metrics-format', metavar='<format>', type=str, choices=['json', 'prometheus'], help='format of --metrics-socket snapshots: json or prometheus (text exposition format) (default is json)')
+    parser.add_argument('--self-benchmark', action='store_true', help='report the cost of pyrunlim itself: startup (from the start of pyrunlim to the start of the command, including imports but not the startup of the python interpreter), time per sample, and teardown (from the end of the command to the stats)')
+    parser.add_argument('--startup-budget', metavar='<float>', type=float, help='startup budget of pyrunlim in milliseconds (implies --self-benchmark): if the startup takes longer, a warning is printed on stderr and over-startup-budget is reported in stats')
+    parser.add_argument('--profile', metavar='<filename>', type=str, help='record a time series of cpu, rss, i/o, context switches and state of each process of the command, and save it to <filename> at exit (numpy .npz if <filename> ends with .npz, csv otherwise)')
+    parser.add_argument('--profile-interval', metavar='<float>', type=float, help='sample the time series every <float> seconds (default 0.1)')
+    parser.add_argument('--profile-size', metavar='<integer>', type=int, help='keep at most <integer> rows in the time series (default 100000)')
+    parser.add_argument('--profile-retention', metavar='<retention>', type=str, choices=['ring', 'decimate'], help='rows kept when the time series is full (ring, i.e., the most recent ones, or decimate, i.e., every other sample, halving the resolution; default is decimate)')
     parser.add_argument('-f', '--frequency', metavar='<integer>', type=int, help='set report frequency to <integer> seconds')
     parser.add_argument('-a', '--affinity', metavar='<integers>', type=str, help='set cpu affinity of the command to <integers> (comma-separated list)')
     parser.add_argument('-A', '--pyrunlim-affinity', metavar='<integers>', type=str, help='set cpu affinity of pyrunlim to <integers> (comma-separated list)')
+    parser.add_argument('-b', '--backend', metavar='<backend>', type=str, choices=['auto', 'cgroup', 'psutil'], default='auto', help='resource accounting backend (auto, cgroup or psutil; default is auto, i.e., cgroup if a delegated cgroup v2 subtree is available, psutil otherwise)')
+    parser.add_argument('--accounting', metavar='<accounting>', type=str, choices=['cheap', 'precise'], default='cheap', help='memory accounting of the psutil backend (cheap, i.e., VmRSS and VmSwap from /proc/<pid>/status, or precise, i.e., Rss and Swap from /proc/<pid>/smaps_rollup; default is cheap)')
+    parser.add_argument('--tracking', metavar='<tracking>', type=str, choices=['auto', 'netlink', 'pidfd', 'poll'], default='auto', help='child tracking of the psutil backend (netlink, i.e., fork and exit events from the proc connector, pidfd, i.e., exit notifications via pidfd_open, or poll, i.e., tree walking at each sample; default is auto, i.e., the first available in this order)')
     parser.add_argument('-n', '--nice', metavar='<integer>', type=int, help='set nice to <integer> (default 20)')
     parser.add_argument('-l', '--log', metavar='<filename>', type=str, help='save log to <filename> (default STDERR)')
-    parser.add_argument('-o', '--output', metavar='<output>', type=str, choices=['text', 'xml'], default='text', help='output format (text or xml; default is text)')
+    parser.add_argument('-o', '--output', metavar='<output>', type=str, choices=['text', 'xml', 'jsonl'], default='text', help='output format (text, xml or jsonl, i.e., one JSON object per line; default is text)')
     parser.add_argument('-R', '--redirect', metavar='<filename>', type=str, help='redirect output (and error) of the command (default is STDOUT)')
     parser.add_argument('-O', '--redirect-output', metavar='<filename>', type=str, help='redirect output of the command (incompatible with -R,--redirect)')
     parser.add_argument('-E', '--redirect-error', metavar='<filename>', type=str, help='redirect error of the command (incompatible with -R,--redirect)')
     parser.add_argument('--no-timestamp', action='store_true', help='do not timestamp output and error of the command')
+    parser.add_argument('--max-line-length', metavar='<integer>', type=int, help='lines of output and error longer than <integer> bytes (default is 1048576) are moved to their redirect files chunk by chunk, and only their first and last <integer>/2 bytes are written in the log, together with their length in bytes')
+    parser.add_argument('--passthrough', action='store_true', help='move output and error of the command to their redirect files as they are, by means of splice if possible, and only count bytes and lines (implies --no-timestamp; incompatible with --regex)')
     parser.add_argument('--regex', metavar='<regex>', type=str, action='append', help='extract data from output and error of the command according to the "named groups" in <regex> (this option can be used several times). For example, --regex "real\\s(?P<minutes>\\d+)m(?P<seconds>\\d+.\\d+)" extracts minutes and seconds from the output of time in bash')
     parser.add_argument('--no-last-sample', action='store_true', help='do not print <last-sample> element when wrapping streams')
     parser.add_argument('--no-print-line', action='store_true', help='do not print <line> element when wrapping streams')
-    parser.add_argument('command', metavar="<command>", help="command to run (and limit)")
+    parser.add_argument('--batch', metavar='<filename>', type=str, help='run the jobs in <filename> (JSON lines, one object per job with key "command" and optionally keys named after long options, e.g., "time", "memory", "redirect-output", "affinity"), writing one record per job in the log (a job giving "output" must also give its own "log"); the exit code is the highest exit code of the jobs, 0 if all of them completed')
+    parser.add_argument('--slots', metavar='<integer>', type=int, help='run the jobs of --batch in <integer> parallel slots, each one pinned to a disjoint set of cpus (jobs in excess are queued)')
+    parser.add_argument('--numa', action='store_true', help='do not let slots span numa nodes, and bind the memory of each job to the numa node of its slot')
+    parser.add_argument('command', metavar="<command>", nargs='?', help="command to run (and limit)")
     parser.add_argument('args', metavar="...", nargs=argparse.REMAINDER, help="arguments for <command>, or escaped pipes, i.e., \|, followed by other commands and arguments")
+    return parser
+
+def parseArguments():
+    parser = argumentParser()
     args = parser.parse_args()
     
+    if args.calibrate != None:
+        if args.calibrate < 1:
+            parser.error("--calibrate requires a positive number of runs")
+    elif (args.command == None) == (args.batch == None):
+        parser.error("either <command> or --batch must be given")
+    if (args.slots != None or args.numa) and args.batch == None:
+        parser.error("--slots and --numa require --batch")
+    if args.slots != None and args.affinity != None:
+        parser.error("--affinity conflicts with --slots (each slot has its own cpus)")
+    return args
+
+def configure(process, args):
     if args.time != None:
         process.timelimit = args.time
     if args.memory != None:
         process.memorylimit = args.memory
     if args.realtime != None:
         process.realtimelimit = args.realtime
+    if args.soft_time != None:
+        process.softtimelimit = args.soft_time
+    if args.soft_memory != None:
+        process.softmemorylimit = args.soft_memory
+    if args.soft_realtime != None:
+        process.softrealtimelimit = args.soft_realtime
+    if args.grace_signal != None:
+        process.graceSignal = args.grace_signal
+    if args.grace != None:
+        process.grace = args.grace
     if args.swap != None:
         process.swaplimit = args.swap
+    if args.io:
+        process.io = True
+    if args.io_read_limit != None:
+        process.ioreadlimit = args.io_read_limit
+        process.io = True
+    if args.io_write_limit != None:
+        process.iowritelimit = args.io_write_limit
+        process.io = True
+    if args.backend != None:
+        process.backendName = args.backend
+    if args.accounting != None:
+        process.accounting = args.accounting
+    if args.tracking != None:
+        process.tracking = args.tracking
+    if args.kernel_limits:
+        process.kernelLimits = True
+    if args.kernel_memory_limit != None:
+        process.kernelMemoryLimit = args.kernel_memory_limit
+    if args.sampling != None:
+        process.sampling = args.sampling
+    if args.perf:
+        process.perf = True
+    if args.self_benchmark:
+        process.selfBenchmark = True
+    if args.startup_budget != None:
+        process.selfBenchmark = True
+        process.startupBudget = args.startup_budget
+    if args.metrics_socket != None:
+        process.metricsSocket = args.metrics_socket
+    if args.metrics_format != None:
+        process.metricsFormat = args.metrics_format
+    if args.profile != None:
+        import importlib.util
+        if args.profile.endswith(".npz") and importlib.util.find_spec("numpy") == None:
+            sys.exit("pyrunlim: numpy is required to save profiles in .npz files")
+        process.profile = Profile(args.profile, args.profile_size if args.profile_size != None else 100000, args.profile_retention if args.profile_retention != None else "decimate")
+        if args.profile_interval != None:
+            process.profileInterval = args.profile_interval
     if args.frequency != None:
         process.reportFrequency = args.frequency
     if args.affinity != None:
         process.affinity = [int(a) for a in args.affinity.split(",")]
-    if args.pyrunlim_affinity != None:
-        process.setPyrunlimAffinity([int(a) for a in args.pyrunlim_affinity.split(",")])
     if args.nice != None:
         process.nice = args.nice
     if args.log != None:
         process.log = open(args.log, 'w')
+        process.closeLog = True
     if args.output != None:
         if args.output == 'text':
             process.output = TextOutput(process)
         elif args.output == 'xml':
             process.output = XmlOutput(process)
+        elif args.output == 'jsonl':
+            process.output = JsonOutput(process)
     if args.redirect != None:
         process.redirectOutput = args.redirect
         process.redirectError = args.redirect
@@ -88,6 +212,15 @@ def parseArguments(process):
         process.redirectError = args.redirect_error
     if args.no_timestamp:
         process.timestamp = False
+    if args.passthrough:
+        if args.regex:
+            sys.exit("pyrunlim: --passthrough is incompatible with --regex")
+        process.timestamp = False
+        process.passthrough = True
+    if args.max_line_length != None:
+        if args.max_line_length < 2:
+            sys.exit("pyrunlim: --max-line-length must be at least 2")
+        process.maxLineLength = args.max_line_length
     if args.no_last_sample:
         process.printLastSample = False
     if args.no_print_line:
@@ -101,54 +234,184 @@ def parseArguments(process):
         if ' ' in arg:
             arg = '"%s"' % arg
         process.args.append(arg)
+    process.calibrationFile = args.calibration_file if args.calibration_file != None else defaultCalibrationFile()
+    if args.direct:
+        import shutil
+        argv = [args.command] + args.args
+        if not any([c in SHELL_SYNTAX for arg in argv for c in arg]) and shutil.which(args.command) != None:
+            process.argv = argv
+
+SHELL_SYNTAX = set("|&;<>()$`\\\"'\t\n*?[]#~{}!")
+
+def parseSignal(value):
+    try:
+        return signal.Signals(int(value))
+    except ValueError:
+        pass
+    try:
+        return signal.Signals[value.upper() if value.upper().startswith("SIG") else "SIG" + value.upper()]
+    except KeyError:
+        raise argparse.ArgumentTypeError("invalid signal: %s" % value)
+
+def defaultCalibrationFile():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pyrunlim", "calibration.json")
+
+def setPyrunlimAffinity(value):
+    os.sched_setaffinity(0, value)
     
 
 class OutputBuilder:
     def __init__(self, process):
         self.process = process
         self.lock = threading.Lock()
+        self.chunk = None
+
+    def write(self, msg):
+        if self.chunk != None:
+            self.chunk.append(msg)
+        else:
+            self.process.log.write(msg)
         
     def report(self):
         self.lock.acquire()
         self._report()
         self.lock.release()
     
-    def reportOutputStream(self, real, line, resources):
+    def reportOutputStream(self, real, lines, resources, size=None):
+        self._reportStream(real, lines, resources, size, "o", self.process.stdoutFile, self._reportOutputStreamBegin, self._reportOutputStreamEnd)
+    
+    def reportErrorStream(self, real, lines, resources, size=None):
+        self._reportStream(real, lines, resources, size, "e", self.process.stderrFile, self._reportErrorStreamBegin, self._reportErrorStreamEnd)
+
+    def writeOutputStream(self, real, data, first):
+        self._writeStream(real, data, first, "o", self.process.stdoutFile)
+
+    def writeErrorStream(self, real, data, first):
+        self._writeStream(real, data, first, "e", self.process.stderrFile)
+
+    def _writeStream(self, real, data, first, prefix, file):
+        # a chunk of a long line, which is reported (truncated) when complete
         self.lock.acquire()
-        
-        if self.process.timestamp:
-            print("[o%10.3f] %s" % (real, line), file=self.process.stdoutFile)
-        else:
-            print(line, file=self.process.stdoutFile)
-        self.process.stdoutFile.flush()
-        
-        self._reportOutputStreamBegin(real, line, resources)
-        for regex in self.process.regexes:
-            match = regex.match(line)
-            if match:
-                self._reportExtract(regex.pattern, match.groupdict())
-        self._reportOutputStreamEnd()
-                
+        if first and self.process.timestamp:
+            file.write("[%s%10.3f] " % (prefix, real))
+        file.write(data)
+        file.flush()
         self.lock.release()
-    
-    def reportErrorStream(self, real, line, resources):
+
+    def _reportStream(self, real, lines, resources, size, prefix, file, begin, end):
         self.lock.acquire()
         
-        if self.process.timestamp:
-            print("[e%10.3f] %s" % (real, line), file=self.process.stderrFile)
+        if size != None:
+            file.write("\n")
+        elif self.process.timestamp:
+            file.write("".join(["[%s%10.3f] %s\n" % (prefix, real, line) for line in lines]))
         else:
-            print(line, file=self.process.stderrFile)
-        self.process.stderrFile.flush()
+            file.write("".join([line + "\n" for line in lines]))
+        file.flush()
         
-        self._reportErrorStreamBegin(real, line, resources)
-        for regex in self.process.regexes:
-            match = regex.match(line)
-            if match:
-                self._reportExtract(regex.pattern, match.groupdict())
-        self._reportErrorStreamEnd()
+        self.chunk = []
+        for line in lines:
+            begin(real, line, resources, size)
+            for (regex, groups) in self.process.extractor.match(line):
+                self._reportExtract(regex.pattern, groups)
+            end()
+        self.process.log.write("".join(self.chunk))
+        self.process.log.flush()
+        self.chunk = None
                 
         self.lock.release()
     
+    def _header(self):
+        res = [("version", VERSION, "%s")]
+        if self.process.job != None:
+            res.append(("job", self.process.job, "%s"))
+        if self.process.slot != None:
+            res.append(("slot", self.process.slot, "%d"))
+        if self.process.memoryNode != None:
+            res.append(("numa-node", self.process.memoryNode, "%d"))
+        res.append(("time-limit", self.process.timelimit, "%d"))
+        res.append(("memory-limit", self.process.memorylimit, "%d"))
+        res.append(("real-time-limit", self.process.realtimelimit, "%d"))
+        res.append(("swap-limit", self.process.swaplimit, "%d"))
+        res.append(("io-read-limit", self.process.ioreadlimit, "%d"))
+        res.append(("io-write-limit", self.process.iowritelimit, "%d"))
+        if self.process.hasSoftLimits():
+            res.append(("soft-time-limit", self.process.softtimelimit, "%d"))
+            res.append(("soft-memory-limit", self.process.softmemorylimit, "%d"))
+            res.append(("soft-real-time-limit", self.process.softrealtimelimit, "%d"))
+            res.append(("grace-signal", self.process.graceSignal.name, "%s"))
+            res.append(("grace", self.process.grace, "%.3f"))
+        res.append(("backend", self.process.backend.describe(), "%s"))
+        res.append(("cpu-affinity", ", ".join([str(a) for a in self.process.affinity]), "%s"))
+        res.append(("pyrunlim-cpu-affinity", ", ".join([str(a) for a in sorted(os.sched_getaffinity(0))]), "%s"))
+        res.append(("nice", self.process.nice, "%d"))
+        res.append(("wrapper", self.process.wrapper(), "%s"))
+        res.append(("sampling", self.process.sampling, "%s"))
+        res.append(("perf", "yes" if self.process.perf else "no", "%s"))
+        res.append(("io", "yes" if self.process.io else "no", "%s"))
+        res.append(("kernel-limits", "cpu, %s" % self.process.kernelMemoryLimit if self.process.kernelLimits else "none", "%s"))
+        res.append(("running", self.process.running(), "%s"))
+        res.append(("start", time.strftime("%c"), "%s"))
+        return res
+
+    def _stats(self):
+        res = [("end", time.strftime("%c"), "%s")]
+        res.append(("status", self.process.status, "%s"))
+        res.append(("result", self.process.result, "%s"))
+        res.append(("enforced-by", self.process.enforcedBy if self.process.enforcedBy != None else "none", "%s"))
+        if self.process.hasSoftLimits():
+            res.append(("soft-limit", self.process.softLimit if self.process.softLimit != None else "none", "%s"))
+            if self.process.softLimit != None:
+                res.append(("soft-limit-real", self.process.softLimitReal, "%.3f"))
+                if self.process.graceLines() != None:
+                    res.append(("grace-lines", self.process.graceLines(), "%d"))
+        res.append(("output", self.process.redirectOutput, "%s"))
+        res.append(("error", self.process.redirectError, "%s"))
+        res.append(("children", len(self.process.subprocesses), "%d"))
+        res.append(("real", self.process.real, "%.3f"))
+        res.append(("time", self.process.system + self.process.user, "%.3f"))
+        res.append(("user", self.process.user, "%.3f"))
+        res.append(("system", self.process.system, "%.3f"))
+        res.append(("memory", self.process.max_memory, "%.1f"))
+        if self.process.io:
+            res.append(("read", self.process.read, "%.1f"))
+            res.append(("write", self.process.write, "%.1f"))
+            res.append(("max-open-files", self.process.max_files, "%d"))
+        res.append(("exact-time", self.process.exact_system + self.process.exact_user, "%.3f"))
+        res.append(("exact-user", self.process.exact_user, "%.3f"))
+        res.append(("exact-system", self.process.exact_system, "%.3f"))
+        res.append(("exact-memory", self.process.exact_max_memory, "%.1f"))
+        if self.process.calibration != None:
+            res.append(("corrected-real", max(0, self.process.real - self.process.calibration["real"]), "%.3f"))
+            res.append(("corrected-exact-time", max(0, self.process.exact_user + self.process.exact_system - self.process.calibration["user"] - self.process.calibration["system"]), "%.3f"))
+            res.append(("corrected-exact-user", max(0, self.process.exact_user - self.process.calibration["user"]), "%.3f"))
+            res.append(("corrected-exact-system", max(0, self.process.exact_system - self.process.calibration["system"]), "%.3f"))
+        res.append(("reaped", self.process.reaped, "%d"))
+        res.append(("subreaper", "yes" if self.process.subreaper else "no", "%s"))
+        for name in ("stdout", "stderr"):
+            res.append(("%s-bytes" % name, self.process.bytes[name], "%d"))
+            if self.process.lines[name] != None:
+                res.append(("%s-lines" % name, self.process.lines[name], "%d"))
+        if self.process.perfCounters != None:
+            res.append(("perf-scope", self.process.perfCounters.scope, "%s"))
+            for (name, type, config) in PerfCounters.EVENTS:
+                if name in self.process.perfCounters.values:
+                    res.append(("perf-%s" % name, self.process.perfCounters.values[name], "%d"))
+        res.append(("samples", self.process.samplings, "%d"))
+        if self.process.selfBenchmark:
+            res.append(("startup-time", 1000 * self.process.benchmark["startup"], "%.1f"))
+            res.append(("import-time", 1000 * self.process.benchmark["imports"], "%.1f"))
+            res.append(("sample-time", 1000 * self.process.samplingTime / max(1, self.process.samplings), "%.3f"))
+            res.append(("teardown-time", 1000 * self.process.benchmark["teardown"], "%.1f"))
+        if self.process.startupBudget != None:
+            res.append(("startup-budget", self.process.startupBudget, "%.1f"))
+            res.append(("over-startup-budget", "yes" if self.process.overStartupBudget() else "no", "%s"))
+        res.append(("time-overshoot", self.process.timeOvershoot, "%.3f"))
+        res.append(("memory-overshoot", self.process.memoryOvershoot, "%.1f"))
+        res.append(("sampling-overhead", self.process.samplingTime, "%.3f"))
+        res.append(("sampling-cpu-overhead", self.process.samplingCpuTime, "%.3f"))
+        return res
+
     def begin(self):
         self.lock.acquire()
         self._begin()
@@ -168,42 +431,59 @@ class TextOutput(OutputBuilder):
         self.process.log.flush()
         
     def _report(self):
-        self.print("sample:\t\t%10.3f\t%10.3f\t%10.3f\t%10.1f\t%10.1f\t%10.1f" % (self.process.real, self.process.user, self.process.system, self.process.max_memory, self.process.rss, self.process.swap))
+        self.print("sample:\t\t%10.3f\t%10.3f\t%10.3f\t%10.1f\t%10.1f\t%10.1f\t%10.1f\t%10.1f" % (self.process.real, self.process.user, self.process.system, self.process.max_memory, self.process.rss, self.process.swap, self.process.read, self.process.write))
 
-    def _reportOutputStreamBegin(self, real, line, resources):
+    def _reportOutputStreamBegin(self, real, line, resources, size):
         pass
 
     def _reportOutputStreamEnd(self):
         pass
 
-    def _reportErrorStreamBegin(self, real, line, resources):
+    def _reportErrorStreamBegin(self, real, line, resources, size):
         pass
 
     def _reportErrorStreamEnd(self):
         pass
 
     def _reportExtract(self, regex, dict):
-        print("[regex %s] " % regex, end="", file=self.process.log)
-        print("\t".join(["%s=%s" % (key, dict[key]) for key in dict.keys()]), file=self.process.log)
-        self.process.log.flush()
+        self.write("[regex %s] " % regex)
+        self.write("\t".join(["%s=%s" % (key, dict[key]) for key in dict.keys()]) + "\n")
+        if self.chunk == None:
+            self.process.log.flush()
 
     def _begin(self):
         self.print("version:\t\t%s" % VERSION)
+        if self.process.job != None:
+            self.print("job:\t\t%s" % self.process.job)
+        if self.process.slot != None:
+            self.print("slot:\t\t%d%s" % (self.process.slot, "" if self.process.memoryNode == None else " (numa node %d)" % self.process.memoryNode))
         self.print("time limit:\t\t%d seconds" % self.process.timelimit)
         self.print("memory limit:\t%d MB" % self.process.memorylimit)
         self.print("real time limit:\t%d seconds" % self.process.realtimelimit)
         self.print("swap limit:\t\t%d MB" % self.process.swaplimit)
-        self.print("pyrunlim cpu affin.:\t[%s]" % ", ".join([str(a) for a in psutil.Process(os.getpid()).cpu_affinity()]))
+        self.print("io read limit:\t%d MB" % self.process.ioreadlimit)
+        self.print("io write limit:\t%d MB" % self.process.iowritelimit)
+        if self.process.hasSoftLimits():
+            self.print("soft limits:\t%d seconds, %d MB, %d seconds (real)" % (self.process.softtimelimit, self.process.softmemorylimit, self.process.softrealtimelimit))
+            self.print("grace:\t\t%s, then %.3f seconds" % (self.process.graceSignal.name, self.process.grace))
+        self.print("backend:\t\t%s" % self.process.backend.describe())
+        self.print("pyrunlim cpu affin.:\t[%s]" % ", ".join([str(a) for a in sorted(os.sched_getaffinity(0))]))
         self.print("cpu affinity:\t[%s]" % ", ".join([str(a) for a in self.process.affinity]))
         self.print("nice:\t\t%d" % self.process.nice)
-        self.print("running:\t\tbash -c \"%s\"" % " ".join(self.process.args).replace('"', '\\"'))
+        self.print("sampling:\t\t%s" % self.process.sampling)
+        self.print("io accounting:\t%s" % ("yes" if self.process.io else "no"))
+        self.print("kernel limits:\t%s" % ("RLIMIT_CPU, RLIMIT_%s" % self.process.kernelMemoryLimit.upper() if self.process.kernelLimits else "none"))
+        self.print("running:\t\t%s" % self.process.running())
         self.print("start:\t\t%s" % time.strftime("%c"))
-        self.print("columns:\t\treal (s)\tuser (s)\tsys (s)  \tmax memory (MB)\trss (MB)   \tswap (MB)")
+        self.print("columns:\t\treal (s)\tuser (s)\tsys (s)  \tmax memory (MB)\trss (MB)   \tswap (MB)  \tread (MB)  \twrite (MB)")
 
     def _end(self):
         self.print("end:  \t\t%s" % time.strftime("%c"))
         self.print("status:\t\t%s" % self.process.status)
         self.print("result:\t\t%s" % str(self.process.result))
+        self.print("enforced by:\t\t%s" % ("none" if self.process.enforcedBy == None else self.process.enforcedBy))
+        if self.process.softLimit != None:
+            self.print("soft limit:\t\t%s at %.3f seconds%s" % (self.process.softLimit, self.process.softLimitReal, "" if self.process.graceLines() == None else ", %d lines during grace" % self.process.graceLines()))
         self.print("output:\t\t%s" % str(self.process.redirectOutput))
         self.print("error:\t\t%s" % str(self.process.redirectError))
         self.print("children:\t\t%d" % len(self.process.subprocesses))
@@ -212,18 +492,46 @@ class TextOutput(OutputBuilder):
         self.print("user:\t\t%.3f seconds" % self.process.user)
         self.print("system:\t\t%.3f seconds" % self.process.system)
         self.print("memory:\t\t%.1f MB" % self.process.max_memory)
+        if self.process.io:
+            self.print("io:\t\t\t%.1f MB read, %.1f MB written, %d max open files" % (self.process.read, self.process.write, self.process.max_files))
+        self.print("exact time:\t\t%.3f seconds" % (self.process.exact_system + self.process.exact_user))
+        self.print("exact user:\t\t%.3f seconds" % self.process.exact_user)
+        self.print("exact system:\t%.3f seconds" % self.process.exact_system)
+        self.print("exact memory:\t%.1f MB (max rss of a single process)" % self.process.exact_max_memory)
+        if self.process.calibration != None:
+            self.print("corrected real:\t%.3f seconds" % max(0, self.process.real - self.process.calibration["real"]))
+            self.print("corrected time:\t%.3f seconds (user %.3f, system %.3f)" % (max(0, self.process.exact_user + self.process.exact_system - self.process.calibration["user"] - self.process.calibration["system"]), max(0, self.process.exact_user - self.process.calibration["user"]), max(0, self.process.exact_system - self.process.calibration["system"])))
+        self.print("reaped:\t\t%d%s" % (self.process.reaped, "" if self.process.subreaper else " (not subreaper)"))
+        for name in ("stdout", "stderr"):
+            self.print("%s:\t\t%d bytes%s" % (name, self.process.bytes[name], "" if self.process.lines[name] == None else ", %d lines" % self.process.lines[name]))
+        for (regex, hits) in zip(self.process.regexes, self.process.extractor.hits):
+            self.print("regex hits:\t\t%d\t%s" % (hits, regex.pattern))
+        if self.process.perfCounters != None:
+            self.print("perf counters:\t%s" % self.process.perfCounters.scope)
+            for (name, type, config) in PerfCounters.EVENTS:
+                if name in self.process.perfCounters.values:
+                    self.print("  %s:\t%d" % (name, self.process.perfCounters.values[name]))
+                else:
+                    self.print("  %s:\tn/a (%s)" % (name, self.process.perfCounters.errors.get(name, "not counted")))
         self.print("samples:\t\t%d" % self.process.samplings)
+        if self.process.selfBenchmark:
+            self.print("self benchmark:\tstartup %.1f ms (imports %.1f ms), %.3f ms per sample, teardown %.1f ms" % (1000 * self.process.benchmark["startup"], 1000 * self.process.benchmark["imports"], 1000 * self.process.samplingTime / max(1, self.process.samplings), 1000 * self.process.benchmark["teardown"]))
+        if self.process.startupBudget != None:
+            self.print("startup budget:\t%.1f ms (%s)" % (self.process.startupBudget, "exceeded" if self.process.overStartupBudget() else "met"))
+        self.print("limit overshoot:\t%.3f seconds, %.1f MB" % (self.process.timeOvershoot, self.process.memoryOvershoot))
+        self.print("sampling overhead:\t%.3f seconds (cpu %.3f seconds, %.3f ms per sample)" % (self.process.samplingTime, self.process.samplingCpuTime, 1000 * self.process.samplingTime / max(1, self.process.samplings)))
 
 class XmlOutput(OutputBuilder):
     def __init__(self, process):
         OutputBuilder.__init__(self, process)
         
     def print(self, msg):
-        print(msg, file=self.process.log, end="")
+        self.write(msg)
 
     def println(self, msg):
-        print(msg, file=self.process.log)
-        self.process.log.flush()
+        self.write(msg + "\n")
+        if self.chunk == None:
+            self.process.log.flush()
 
     def cdata(self, data):
         LIMIT = 10000
@@ -233,12 +541,12 @@ class XmlOutput(OutputBuilder):
             if len(data) > LIMIT: self.print("</long-text>\n")
             
     def _report(self):
-        self.println("<sample real='%.3f' user='%.3f' sys='%.3f' max-memory='%.1f' rss='%.1f' swap='%.1f' />" % (self.process.real, self.process.user, self.process.system, self.process.max_memory, self.process.rss, self.process.swap))
+        self.println("<sample real='%.3f' user='%.3f' sys='%.3f' max-memory='%.1f' rss='%.1f' swap='%.1f' read='%.1f' write='%.1f' />" % (self.process.real, self.process.user, self.process.system, self.process.max_memory, self.process.rss, self.process.swap, self.process.read, self.process.write))
     
-    def _reportOutputStreamBegin(self, real, line, resources):
-        self.print("<stream type='stdout' real='%.3f'>" % real)
+    def _reportOutputStreamBegin(self, real, line, resources, size):
+        self.print("<stream type='stdout' real='%.3f'%s>" % (real, "" if size == None else " bytes='%d'" % size))
         if self.process.printLastSample:
-            self.print("<last-sample real='%.3f' user='%.3f' sys='%.3f' max-memory='%.1f' rss='%.1f' swap='%.1f' />" % resources)
+            self.print("<last-sample real='%.3f' user='%.3f' sys='%.3f' max-memory='%.1f' rss='%.1f' swap='%.1f' read='%.1f' write='%.1f' />" % resources)
         if self.process.printLine:
             self.print("<line>")
             self.cdata(line)
@@ -247,10 +555,10 @@ class XmlOutput(OutputBuilder):
     def _reportOutputStreamEnd(self):
         self.println("</stream>")
 
-    def _reportErrorStreamBegin(self, real, line, resources):
-        self.print("<stream type='stderr' real='%.3f'>" % real)
+    def _reportErrorStreamBegin(self, real, line, resources, size):
+        self.print("<stream type='stderr' real='%.3f'%s>" % (real, "" if size == None else " bytes='%d'" % size))
         if self.process.printLastSample:
-            self.print("<last-sample real='%.3f' user='%.3f' sys='%.3f' max-memory='%.1f' rss='%.1f' swap='%.1f' />" % resources)
+            self.print("<last-sample real='%.3f' user='%.3f' sys='%.3f' max-memory='%.1f' rss='%.1f' swap='%.1f' read='%.1f' write='%.1f' />" % resources)
         if self.process.printLine:
             self.print("<line>")
             self.cdata(line)
@@ -272,35 +580,183 @@ class XmlOutput(OutputBuilder):
         self.print("</match>")
 
     def _begin(self):
-        self.print("<pyrunlim version='%s'" % VERSION)
-        self.print(" time-limit='%d'" % self.process.timelimit)
-        self.print(" memory-limit='%d'" % self.process.memorylimit)
-        self.print(" real-time-limit='%d'" % self.process.realtimelimit)
-        self.print(" swap-limit='%d'" % self.process.swaplimit)
-        self.print(" cpu-affinity='%s'" % ", ".join([str(a) for a in self.process.affinity]))
-        self.print(" pyrunlim-cpu-affinity='%s'" % ", ".join([str(a) for a in psutil.Process(os.getpid()).cpu_affinity()]))
-        self.print(" nice='%d'" % self.process.nice)
-        self.print(" running='bash -c \"%s\"'" % " ".join(self.process.args).replace("'", "&apos;").replace('"', '\\"'))
-        self.print(" start='%s'" % time.strftime("%c"))
+        self.print("<pyrunlim")
+        for (key, value, format) in self._header():
+            self.print(" %s='%s'" % (key, (format % value).replace("'", "&apos;")))
         self.println(">")
 
     def _end(self):
         self.print("<stats")
-        self.print(" end='%s'" % time.strftime("%c"))
-        self.print(" status='%s'" % self.process.status)
-        self.print(" result='%s'" % str(self.process.result))
-        self.print(" output='%s'" % str(self.process.redirectOutput))
-        self.print(" error='%s'" % str(self.process.redirectError))
-        self.print(" children='%d'" % len(self.process.subprocesses))
-        self.print(" real='%.3f'" % self.process.real)
-        self.print(" time='%.3f'" % (self.process.system + self.process.user))
-        self.print(" user='%.3f'" % self.process.user)
-        self.print(" system='%.3f'" % self.process.system)
-        self.print(" memory='%.1f'" % self.process.max_memory)
-        self.print(" samples='%d'" % self.process.samplings)
-        self.println("/>")
+        for (key, value, format) in self._stats():
+            self.print(" %s='%s'" % (key, format % value))
+        if not self.process.regexes:
+            self.println("/>")
+        else:
+            self.println(">")
+            for (regex, hits) in zip(self.process.regexes, self.process.extractor.hits):
+                self.print("<regex hits='%d'>" % hits)
+                self.cdata(regex.pattern)
+                self.println("</regex>")
+            self.println("</stats>")
         self.println("</pyrunlim>")
 
+class JsonOutput(OutputBuilder):
+    def __init__(self, process):
+        OutputBuilder.__init__(self, process)
+        self.stream = None
+
+    def record(self, record):
+        self.write(json.dumps(record, separators=(",", ":")) + "\n")
+        if self.chunk == None:
+            self.process.log.flush()
+
+    def _value(self, value, format):
+        if format == "%d":
+            # missing limits are null rather than 10**100
+            return int(value) if value < 10**100 else None
+        if format.endswith("f"):
+            return float(format % value)
+        return value
+
+    def _sample(self, resources):
+        return [round(resources[0], 3), round(resources[1], 3), round(resources[2], 3)] + [round(value, 1) for value in resources[3:]]
+
+    def _report(self):
+        self.record({"type": "sample", "sample": self._sample((self.process.real, self.process.user, self.process.system, self.process.max_memory, self.process.rss, self.process.swap, self.process.read, self.process.write))})
+
+    def _reportStreamBegin(self, type, real, line, resources, size):
+        self.stream = {"type": type, "real": round(real, 3)}
+        if size != None:
+            self.stream["bytes"] = size
+        if self.process.printLastSample:
+            self.stream["sample"] = self._sample(resources)
+        if self.process.printLine:
+            self.stream["line"] = line
+
+    def _reportOutputStreamBegin(self, real, line, resources, size):
+        self._reportStreamBegin("stdout", real, line, resources, size)
+
+    def _reportOutputStreamEnd(self):
+        self.record(self.stream)
+
+    def _reportErrorStreamBegin(self, real, line, resources, size):
+        self._reportStreamBegin("stderr", real, line, resources, size)
+
+    def _reportErrorStreamEnd(self):
+        self.record(self.stream)
+
+    def _reportExtract(self, regex, dict):
+        self.stream.setdefault("matches", []).append({"regex": regex, "groups": dict})
+
+    def _begin(self):
+        record = {"type": "begin"}
+        for (key, value, format) in self._header():
+            record[key] = self._value(value, format)
+        record["columns"] = ["real", "user", "sys", "max-memory", "rss", "swap", "read", "write"]
+        self.record(record)
+
+    def _end(self):
+        record = {"type": "stats"}
+        for (key, value, format) in self._stats():
+            record[key] = self._value(value, format)
+        if self.process.regexes:
+            record["regex-hits"] = [{"regex": regex.pattern, "hits": hits} for (regex, hits) in zip(self.process.regexes, self.process.extractor.hits)]
+        self.record(record)
+
+class RegexExtractor:
+    def __init__(self, regexes):
+        self.regexes = regexes
+        self.hits = [0] * len(regexes)
+        self.literals = [RegexExtractor._requiredLiteral(regex) for regex in regexes]
+        self.combined = None
+        self.prefilter = None
+        self.alternatives = []
+        self.single = list(range(len(regexes)))
+
+        alternatives = []
+        for (index, regex) in enumerate(regexes):
+            pattern = RegexExtractor._rename(index, regex)
+            if pattern != None:
+                alternatives.append((index, pattern))
+        if len(alternatives) > 1:
+            try:
+                self.combined = re.compile("|".join(["(?P<_%d>%s)" % (index, pattern) for (index, pattern) in alternatives]))
+                self.alternatives = [index for (index, pattern) in alternatives]
+                self.single = [index for index in self.single if index not in self.alternatives]
+            except re.error:
+                pass
+        if self.combined != None and None not in [self.literals[index] for index in self.alternatives]:
+            self.prefilter = re.compile("|".join([re.escape(self.literals[index]) for index in self.alternatives]))
+
+    @staticmethod
+    def _rename(index, regex):
+        if regex.flags & ~re.UNICODE or re.search(r"\\[1-9]|\(\?P=|\(\?\(", regex.pattern):
+            return None
+        pattern = regex.pattern
+        for name in regex.groupindex:
+            pattern = pattern.replace("(?P<%s>" % name, "(?P<_%d_%s>" % (index, name))
+        try:
+            renamed = re.compile(pattern)
+        except re.error:
+            return None
+        if renamed.groups != regex.groups or sorted(renamed.groupindex) != sorted(["_%d_%s" % (index, name) for name in regex.groupindex]):
+            return None
+        return pattern
+
+    @staticmethod
+    def _requiredLiteral(regex):
+        if regex.flags & re.IGNORECASE:
+            return None
+        try:
+            runs = RegexExtractor._literalRuns(sre_parse.parse(regex.pattern))
+        except re.error:
+            return None
+        return max(runs, key=len) or None
+
+    @staticmethod
+    def _literalRuns(items):
+        res = []
+        run = ""
+        for (op, av) in items:
+            if op == sre_parse.LITERAL:
+                run = run + chr(av)
+                continue
+            res.append(run)
+            run = ""
+            if op == sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+                res.extend(RegexExtractor._literalRuns(av[3]))
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and av[0] >= 1:
+                res.extend(RegexExtractor._literalRuns(av[2]))
+        res.append(run)
+        return res
+
+    def _candidate(self, index, line):
+        return self.literals[index] == None or self.literals[index] in line
+
+    def match(self, line):
+        res = []
+        if self.combined != None and (self.prefilter == None or self.prefilter.search(line)):
+            match = self.combined.match(line)
+            if match:
+                index = int(match.lastgroup[1:])
+                res.append((index, dict([(name, match.group("_%d_%s" % (index, name))) for name in self.regexes[index].groupindex])))
+                for other in self.alternatives[self.alternatives.index(index) + 1:]:
+                    if self._candidate(other, line):
+                        match = self.regexes[other].match(line)
+                        if match:
+                            res.append((other, match.groupdict()))
+        for index in self.single:
+            if self._candidate(index, line):
+                match = self.regexes[index].match(line)
+                if match:
+                    res.append((index, match.groupdict()))
+        if not res:
+            return res
+        res.sort(key=lambda item: item[0])
+        for (index, groups) in res:
+            self.hits[index] = self.hits[index] + 1
+        return [(self.regexes[index], groups) for (index, groups) in res]
+
 class Subprocess:
     def __init__(self):
         self.user = 0
@@ -308,17 +764,956 @@ class Subprocess:
     
         self.rss = 0
         self.swap = 0
+
+        self.read = 0
+        self.write = 0
+        self.files = 0
+        self.start = None
+        self.exited = False
         
-    def update(self, times, memory_info, memory_maps):
+    def update(self, times, memory):
+        self.updateTimes(times)
+        (self.rss, self.swap) = memory
+
+    def updateTimes(self, times):
+        self.start = times.start
         if times.user > self.user:
             self.user = times.user
         if times.system > self.system:
             self.system = times.system
+
+def readProcKeys(pid, filename):
+    res = {}
+    with open("/proc/%d/%s" % (pid, filename)) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0][-1] == ':':
+                res[fields[0][:-1]] = fields[1]
+    return res
+
+CpuTimes = collections.namedtuple("CpuTimes", ["user", "system", "cuser", "csystem", "start"])
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+SAMPLING_MIN_DELAY = .01
+SAMPLING_MAX_DELAY = 2
+SAMPLING_RATE_HALF_LIFE = 10
+
+RLIMIT_MEMORY_THRESHOLD = .9
+RLIMIT_MEMORY_SIGNALS = (signal.SIGSEGV, signal.SIGBUS, signal.SIGABRT, signal.SIGKILL)
+
+def readProcTimes(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return CpuTimes(int(fields[11]) / CLOCK_TICKS, int(fields[12]) / CLOCK_TICKS, int(fields[13]) / CLOCK_TICKS, int(fields[14]) / CLOCK_TICKS, int(fields[19]))
+
+def readProcIo(pid):
+    io = readProcKeys(pid, "io")
+    return (int(io["rchar"]), int(io["wchar"]))
+
+def cheapMemoryUsage(pid):
+    status = readProcKeys(pid, "status")
+    return (int(status.get("VmRSS", 0)) * 1024, int(status.get("VmSwap", 0)) * 1024)
+
+def preciseMemoryUsage(pid):
+    try:
+        rollup = readProcKeys(pid, "smaps_rollup")
+        return (int(rollup.get("Rss", 0)) * 1024, int(rollup.get("Swap", 0)) * 1024)
+    except FileNotFoundError:
+        if not os.path.exists("/proc/%d" % pid):
+            raise
+        import psutil
+        try:
+            p = psutil.Process(pid)
+            return (p.memory_info().rss, sum([m.swap for m in p.memory_maps()]))
+        except psutil.Error as e:
+            raise OSError(str(e))
+
+def procChildren(pid):
+    res = []
+    for tid in os.listdir("/proc/%d/task" % pid):
+        try:
+            with open("/proc/%d/task/%s/children" % (pid, tid)) as f:
+                res.extend([int(child) for child in f.read().split()])
+        except OSError:
+            pass
+    return res
+
+def procDescendants(pid):
+    res = []
+    stack = [pid]
+    while stack:
+        try:
+            children = procChildren(stack.pop())
+        except OSError:
+            continue
+        res.extend(children)
+        stack.extend(children)
+    return res
+
+def procAlive(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return False
+
+def procGroup(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return int(f.read().rsplit(")", 1)[1].split()[2])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def procIgnores(pid, signum):
+    try:
+        return int(readProcKeys(pid, "status").get("SigIgn", "0"), 16) & (1 << (signum - 1)) != 0
+    except (OSError, ValueError):
+        return False
+
+ProcSample = collections.namedtuple("ProcSample", ["ppid", "command", "state", "user", "system", "rss", "read", "write", "voluntary", "involuntary"])
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+def readProcSample(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        (head, tail) = f.read().rsplit(")", 1)
+    fields = tail.split()
+    status = readProcKeys(pid, "status")
+    try:
+        io = readProcKeys(pid, "io")
+    except OSError:
+        io = {}
+    return ProcSample(int(fields[1]), head.split("(", 1)[1], fields[0], int(fields[11]) / CLOCK_TICKS, int(fields[12]) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE, int(io.get("rchar", 0)), int(io.get("wchar", 0)), int(status.get("voluntary_ctxt_switches", 0)), int(status.get("nonvoluntary_ctxt_switches", 0)))
+
+class Profile:
+    COLUMNS = [("sample", "q"), ("time", "d"), ("pid", "q"), ("ppid", "q"), ("state", "b"), ("user", "d"), ("system", "d"), ("rss", "q"), ("read", "q"), ("write", "q"), ("voluntary", "q"), ("involuntary", "q")]
+
+    def __init__(self, filename, size, retention):
+        self.filename = filename
+        self.size = size
+        self.retention = retention
+        self.columns = {name: array.array(code) for (name, code) in Profile.COLUMNS}
+        self.commands = {}
+        self.samples = 0
+        self.stride = 1
+        self.next = 0
+
+    def sample(self, real, pids):
+        if self.samples % self.stride == 0:
+            for pid in pids:
+                try:
+                    sample = readProcSample(pid)
+                except (OSError, IndexError, ValueError):
+                    continue
+                self.commands[pid] = sample.command
+                self._append((self.samples, real, pid, sample.ppid, ord(sample.state[0]), sample.user, sample.system, sample.rss, sample.read, sample.write, sample.voluntary, sample.involuntary))
+        self.samples = self.samples + 1
+
+    def _append(self, row):
+        if len(self.columns["sample"]) >= self.size and self.retention == "decimate":
+            self._decimate(row[0])
+            if len(self.columns["sample"]) >= self.size or row[0] % self.stride != 0:
+                return
+        if len(self.columns["sample"]) < self.size:
+            for ((name, code), value) in zip(Profile.COLUMNS, row):
+                self.columns[name].append(value)
+        else:
+            for ((name, code), value) in zip(Profile.COLUMNS, row):
+                self.columns[name][self.next] = value
+            self.next = (self.next + 1) % self.size
+    
+    def _decimate(self, sample):
+        # drop every other sample until there is room for the row, or its sample is dropped as well;
+        # if no row can be dropped (e.g., the rows of sample 0 alone fill the time series), the row is too
+        while len(self.columns["sample"]) >= self.size and sample % self.stride == 0:
+            keep = [i for (i, kept) in enumerate(self.columns["sample"]) if kept % (2 * self.stride) == 0]
+            if len(keep) == len(self.columns["sample"]):
+                return
+            self.stride = self.stride * 2
+            for (name, code) in Profile.COLUMNS:
+                self.columns[name] = array.array(code, [self.columns[name][i] for i in keep])
+
+    def write(self):
+        order = list(range(self.next, len(self.columns["sample"]))) + list(range(self.next))
+        columns = {name: [self.columns[name][i] for i in order] for (name, code) in Profile.COLUMNS}
+        columns["state"] = [chr(state) for state in columns["state"]]
+        commands = [self.commands.get(pid, "") for pid in columns["pid"]]
+        if self.filename.endswith(".npz"):
+            import numpy
+            arrays = {name: numpy.array(columns[name], dtype=code if code != "b" else "U1") for (name, code) in Profile.COLUMNS}
+            numpy.savez_compressed(self.filename, command=numpy.array(commands, dtype=str), **arrays)
+            return
+        with open(self.filename, "w", newline="") as f:
+            import csv
+            writer = csv.writer(f)
+            writer.writerow(["sample", "time", "pid", "ppid", "command", "state", "user", "system", "rss", "read", "write", "voluntary", "involuntary"])
+            for i in range(len(order)):
+                writer.writerow([columns["sample"][i], "%.3f" % columns["time"][i], columns["pid"][i], columns["ppid"][i], commands[i], columns["state"][i], "%.2f" % columns["user"][i], "%.2f" % columns["system"][i], columns["rss"][i], columns["read"][i], columns["write"][i], columns["voluntary"][i], columns["involuntary"][i]])
+
+class ChildTracker:
+    def __init__(self, process, lock):
+        self.process = process
+        self.lock = lock
+        self.alive = set()
+        self.running = True
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def track(self, spawn):
+        with self.lock:
+            res = spawn()
+            self._fork(res.pid)
+        self.thread.start()
+        return res
+
+    def pids(self):
+        return list(self.alive)
+
+    def stop(self):
+        self.running = False
+        os.write(self.wakeup[1], b"\0")
+        if self.thread.is_alive():
+            self.thread.join()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+    def _fork(self, pid):
+        self.alive.add(pid)
+        if pid not in self.process.subprocesses:
+            self.process.subprocesses[pid] = Subprocess()
+
+    def _exit(self, pid):
+        if pid not in self.alive:
+            return
+        self.alive.discard(pid)
+        self.process.subprocesses[pid].rss = 0
+        self.process.subprocesses[pid].swap = 0
+
+    def refresh(self):
+        pass
+
+    def _rescan(self):
+        if self.process.rootExited:
+            # processes orphaned by the exit of their parent are children of pyrunlim (see setChildSubreaper)
+            for pid in reaper.children(self.process):
+                if pid not in self.alive:
+                    self._fork(pid)
+        for pid in list(self.alive):
+            try:
+                children = procChildren(pid)
+            except OSError:
+                continue
+            for child in children:
+                if child not in self.alive:
+                    self._fork(child)
+
+class NetlinkTracker(ChildTracker):
+    NETLINK_CONNECTOR = 11
+    NLMSG_DONE = 3
+    CN_IDX_PROC = 1
+    CN_VAL_PROC = 1
+    PROC_CN_MCAST_LISTEN = 1
+    PROC_CN_MCAST_IGNORE = 2
+    PROC_EVENT_FORK = 0x00000001
+    PROC_EVENT_EXIT = 0x80000000
+
+    def __init__(self, process, lock):
+        ChildTracker.__init__(self, process, lock)
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NetlinkTracker.NETLINK_CONNECTOR)
+        try:
+            self.socket.bind((0, NetlinkTracker.CN_IDX_PROC))
+            self._control(NetlinkTracker.PROC_CN_MCAST_LISTEN)
+        except OSError:
+            self.socket.close()
+            raise
+
+    def describe(self):
+        return "netlink"
+
+    def _control(self, op):
+        header = struct.pack("=IHHII", 40, NetlinkTracker.NLMSG_DONE, 0, 0, os.getpid())
+        message = struct.pack("=IIIIHHI", NetlinkTracker.CN_IDX_PROC, NetlinkTracker.CN_VAL_PROC, 0, 0, 4, 0, op)
+        self.socket.send(header + message)
+
+    def _run(self):
+        while self.running:
+            if self.socket not in select.select([self.socket, self.wakeup[0]], [], [])[0]:
+                continue
+            try:
+                data = self.socket.recv(65536)
+            except OSError:
+                with self.lock:
+                    self._rescan()
+                continue
+            offset = 0
+            while offset + 60 <= len(data):
+                length = struct.unpack_from("=I", data, offset)[0]
+                what = struct.unpack_from("=I", data, offset + 36)[0]
+                if what == NetlinkTracker.PROC_EVENT_FORK:
+                    (parent_pid, parent_tgid, child_pid, child_tgid) = struct.unpack_from("=IIII", data, offset + 52)
+                    if child_pid == child_tgid:
+                        with self.lock:
+                            if parent_tgid in self.alive:
+                                self._fork(child_pid)
+                elif what == NetlinkTracker.PROC_EVENT_EXIT:
+                    (pid, tgid) = struct.unpack_from("=II", data, offset + 52)
+                    if pid == tgid:
+                        with self.lock:
+                            self._exit(pid)
+                offset = offset + ((length + 3) & ~3)
+        try:
+            self._control(NetlinkTracker.PROC_CN_MCAST_IGNORE)
+        except OSError:
+            pass
+        self.socket.close()
+
+class PidfdTracker(ChildTracker):
+    def __init__(self, process, lock):
+        ChildTracker.__init__(self, process, lock)
+        if not hasattr(os, "pidfd_open"):
+            raise OSError("pidfd_open is not available")
+        if not os.path.exists("/proc/self/task/%d/children" % os.getpid()):
+            raise OSError("/proc/<pid>/task/<tid>/children is not available")
+        self.pidfds = {}
+
+    def describe(self):
+        return "pidfd"
+
+    def _exit(self, pid):
+        if pid in self.pidfds:
+            os.close(self.pidfds.pop(pid))
+        ChildTracker._exit(self, pid)
+
+    def refresh(self):
+        # no event for forks: new processes are found at each sample, while exits are notified
+        self._rescan()
+
+    def _fork(self, pid):
+        ChildTracker._fork(self, pid)
+        try:
+            self.pidfds[pid] = os.pidfd_open(pid)
+        except OSError:
+            self._exit(pid)
+            return
+        os.write(self.wakeup[1], b"\0")
+
+    def _run(self):
+        while self.running:
+            with self.lock:
+                pids = dict((fd, pid) for (pid, fd) in self.pidfds.items())
+            ready = select.select(list(pids) + [self.wakeup[0]], [], [])[0]
+            if self.wakeup[0] in ready:
+                os.read(self.wakeup[0], 4096)
+            with self.lock:
+                for fd in ready:
+                    if fd in pids:
+                        self._exit(pids[fd])
+        with self.lock:
+            for pid in list(self.pidfds):
+                os.close(self.pidfds.pop(pid))
+
+def createTracker(process, lock):
+    if process.tracking == "poll":
+        return None
+    trackers = {"auto": [NetlinkTracker, PidfdTracker], "netlink": [NetlinkTracker], "pidfd": [PidfdTracker]}[process.tracking]
+    for tracker in trackers:
+        try:
+            return tracker(process, lock)
+        except OSError as e:
+            error = e
+    if process.tracking != "auto":
+        sys.exit("pyrunlim: cannot use %s tracking: %s" % (process.tracking, error))
+    return None
+
+class PsutilBackend:
+    def __init__(self, process):
+        self.process = process
+        self.memoryUsage = preciseMemoryUsage if process.accounting == "precise" else cheapMemoryUsage
+        self.lock = threading.Lock()
+        self.tracker = createTracker(process, self.lock)
+
+    def describe(self):
+        return "psutil (%s accounting, %s tracking)" % (self.process.accounting, "poll" if self.tracker is None else self.tracker.describe())
+
+    def preexec(self):
+        pass
+
+    def spawn(self, spawn):
+        if self.tracker is None:
+            return spawn()
+        return self.tracker.track(spawn)
+
+    def update(self):
+        with self.lock:
+            self._update()
+
+    def pids(self):
+        with self.lock:
+            return self._pids()
+
+    def _pids(self):
+        if self.tracker is not None:
+            self.tracker.refresh()
+            return self.tracker.pids()
+        # processes orphaned by the exit of their parent are children of pyrunlim (see setChildSubreaper)
+        roots = [self.process.process.pid] + [pid for pid in reaper.children(self.process) if pid != self.process.process.pid]
+        return roots + [pid for root in roots for pid in procDescendants(root)]
+
+    def _update(self):
+        # a process reaped by its parent adds its times (and those of the children it reaped) to the
+        # cutime and cstime of the parent, and a process reaped by pyrunlim to exact_user and
+        # exact_system: the cpu times of the command are those of the processes still in /proc,
+        # plus their cutime and cstime, plus the exact times. Reading the exact times first, and
+        # parents before their children, a process reaped in the meantime is never counted twice
+        # (and the time of short-lived processes is not lost between samples)
+        process = self.process
+        (user, system) = (process.exact_user, process.exact_system)
+        subprocesses = self._pids()
         
-        self.rss = memory_info.rss
-        self.swap = 0
-        for m in memory_maps:
-            self.swap = self.swap + m.swap
+        rss = 0
+        swap = 0
+        for pid in sorted(subprocesses, key=lambda pid: (process.subprocesses[pid].start if pid in process.subprocesses and process.subprocesses[pid].start != None else float("inf"), pid)):
+            if pid not in process.subprocesses:
+                process.subprocesses[pid] = Subprocess()
+                    
+            try:
+                times = readProcTimes(pid)
+                process.subprocesses[pid].update(times, self.memoryUsage(pid))
+                user = user + times.user + times.cuser
+                system = system + times.system + times.csystem
+            except (OSError, IndexError, ValueError):
+                pass
+            
+            rss = rss + process.subprocesses[pid].rss
+            swap = swap + process.subprocesses[pid].swap
+
+        process.rss = rss / 1024 / 1024
+        process.swap = swap / 1024 / 1024
+
+        if process.rss + process.swap > process.max_memory:
+            process.max_memory = process.rss + process.swap
+
+        process.user = max(process.user, user)
+        process.system = max(process.system, system)
+
+    def kill(self, graceful=True):
+        subprocesses = sorted(set(procDescendants(self.process.process.pid) + self.process.commandPids()))
+        for pid in subprocesses if graceful else []:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        # processes ignoring SIGTERM (as the command does, by default) are not waited for
+        handling = [pid for pid in subprocesses if not procIgnores(pid, signal.SIGTERM)]
+        deadline = time.time() + (10 if graceful else 0)
+        while time.time() < deadline and any([procAlive(pid) for pid in handling]):
+            time.sleep(.01)
+        for pid in subprocesses:
+            if procAlive(pid):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def owns(self, pid):
+        return False
+
+    def finish(self):
+        if self.tracker is not None:
+            self.tracker.stop()
+            with self.lock:
+                for pid in self.tracker.pids():
+                    self.tracker._exit(pid)
+
+class CgroupBackend:
+    counter = 0
+    base = None
+    lock = threading.Lock()
+
+    def __init__(self, process):
+        self.process = process
+        
+        with CgroupBackend.lock:
+            base = CgroupBackend._base()
+            CgroupBackend.counter = CgroupBackend.counter + 1
+            self.path = os.path.join(base, "pyrunlim-%d-%d" % (os.getpid(), CgroupBackend.counter))
+        os.mkdir(self.path)
+        try:
+            if not os.path.exists(os.path.join(self.path, "memory.current")):
+                raise OSError("memory controller not available in %s" % base)
+            self._write("memory.oom.group", "1")
+            if process.memorylimit < 10**100:
+                self._write("memory.max", str(process.memorylimit * 1024 * 1024))
+            if process.swaplimit < 10**100 and os.path.exists(os.path.join(self.path, "memory.swap.max")):
+                self._write("memory.swap.max", str(process.swaplimit * 1024 * 1024))
+        except OSError:
+            os.rmdir(self.path)
+            raise
+        
+    @staticmethod
+    def _base():
+        # pyrunlim delegates its cgroup once (moving itself to a supervisor cgroup): the cgroups of
+        # all commands, e.g., of --batch and --calibrate, are siblings in the cgroup it started in
+        if CgroupBackend.base == None:
+            base = CgroupBackend._ownCgroup()
+            CgroupBackend._delegate(base)
+            CgroupBackend.base = base
+        return CgroupBackend.base
+
+    @staticmethod
+    def _ownCgroup():
+        mount = None
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields = line.split()
+                if fields[fields.index("-") + 1] == "cgroup2":
+                    mount = fields[4]
+                    break
+        if mount is None:
+            raise OSError("cgroup v2 is not mounted")
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return mount + line[3:].strip().rstrip("/")
+        raise OSError("cgroup v2 hierarchy not found in /proc/self/cgroup")
+
+    @staticmethod
+    def _delegate(base):
+        with open(os.path.join(base, "cgroup.controllers")) as f:
+            controllers = [c for c in f.read().split() if c == "memory"]
+        with open(os.path.join(base, "cgroup.subtree_control")) as f:
+            enabled = f.read().split()
+        controllers = [c for c in controllers if c not in enabled]
+        if not controllers:
+            return
+        
+        with open(os.path.join(base, "cgroup.procs")) as f:
+            procs = [int(pid) for pid in f.read().split()]
+        if procs:
+            if procs != [os.getpid()]:
+                raise OSError("cgroup %s is not delegated (it contains other processes)" % base)
+            supervisor = os.path.join(base, "pyrunlim-supervisor-%d" % os.getpid())
+            if not os.path.exists(supervisor):
+                os.mkdir(supervisor)
+            with open(os.path.join(supervisor, "cgroup.procs"), "w") as f:
+                f.write(str(os.getpid()))
+            atexit.register(CgroupBackend._undelegate, base, supervisor, controllers)
+        with open(os.path.join(base, "cgroup.subtree_control"), "w") as f:
+            f.write(" ".join(["+" + c for c in controllers]))
+
+    @staticmethod
+    def _undelegate(base, supervisor, controllers):
+        # pyrunlim can go back to its cgroup only once the controllers it enabled are disabled
+        try:
+            with open(os.path.join(base, "cgroup.subtree_control"), "w") as f:
+                f.write(" ".join(["-" + c for c in controllers]))
+            with open(os.path.join(base, "cgroup.procs"), "w") as f:
+                f.write(str(os.getpid()))
+            os.rmdir(supervisor)
+        except OSError:
+            pass
+
+    def _read(self, filename):
+        with open(os.path.join(self.path, filename)) as f:
+            return f.read()
+
+    def _readKeys(self, filename):
+        try:
+            return dict((key, int(value)) for (key, value) in (line.split() for line in self._read(filename).splitlines()))
+        except FileNotFoundError:
+            return {}
+
+    def _readInt(self, filename):
+        try:
+            return int(self._read(filename))
+        except FileNotFoundError:
+            return 0
+
+    def _write(self, filename, value):
+        with open(os.path.join(self.path, filename), "w") as f:
+            f.write(value)
+
+    def describe(self):
+        return "cgroup %s" % self.path
+
+    def preexec(self):
+        self._write("cgroup.procs", str(os.getpid()))
+
+    def spawn(self, spawn):
+        return spawn()
+
+    def owns(self, pid):
+        try:
+            with open("/proc/%d/cgroup" % pid) as f:
+                return any([line.startswith("0::") and self.path.endswith(line[3:].strip()) for line in f])
+        except OSError:
+            return False
+
+    def pids(self):
+        return [int(pid) for pid in self._read("cgroup.procs").split()]
+
+    def update(self):
+        process = self.process
+
+        for pid in self.pids():
+            if pid not in process.subprocesses:
+                process.subprocesses[pid] = Subprocess()
+
+        cpu = self._readKeys("cpu.stat")
+        process.user = cpu.get("user_usec", 0) / 1000000
+        process.system = cpu.get("system_usec", 0) / 1000000
+
+        # memory.current (and memory.peak) include the page cache of the files read and written by the
+        # command, which is reclaimed before memory.max is reached: file pages are not accounted as rss
+        process.rss = max(0, self._readInt("memory.current") - self._readKeys("memory.stat").get("file", 0)) / 1024 / 1024
+        process.swap = self._readInt("memory.swap.current") / 1024 / 1024
+        if process.rss + process.swap > process.max_memory:
+            process.max_memory = process.rss + process.swap
+        
+        process.oomKills = self._readKeys("memory.events").get("oom_kill", 0)
+        process.swapFailures = self._readKeys("memory.swap.events").get("fail", 0)
+
+    def kill(self, graceful=True):
+        try:
+            self._write("cgroup.kill", "1")
+        except FileNotFoundError:
+            for pid in self._read("cgroup.procs").split():
+                try:
+                    os.kill(int(pid), signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+    def finish(self):
+        self.update()
+        if "populated 1" in self._read("cgroup.events"):
+            self.kill()
+            for i in range(100):
+                if "populated 0" in self._read("cgroup.events"):
+                    break
+                time.sleep(.01)
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+def createBackend(process):
+    if process.backendName == "psutil":
+        return PsutilBackend(process)
+    try:
+        return CgroupBackend(process)
+    except OSError as e:
+        if process.backendName == "cgroup":
+            sys.exit("pyrunlim: cannot use cgroup backend: %s" % e)
+        return PsutilBackend(process)
+
+def setChildSubreaper():
+    PR_SET_CHILD_SUBREAPER = 36
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) == 0
+    except (OSError, AttributeError):
+        return False
+
+SYSCALLS = {"set_mempolicy": {"x86_64": 238, "aarch64": 237, "i686": 276}, "perf_event_open": {"x86_64": 298, "aarch64": 241, "i686": 336}}
+
+def resolveSyscall(name):
+    number = SYSCALLS[name].get(os.uname().machine)
+    if number == None:
+        raise OSError("%s is not supported on %s" % (name, os.uname().machine))
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.syscall.restype = ctypes.c_long
+        return (libc.syscall, number)
+    except AttributeError as e:
+        raise OSError(str(e))
+
+def memoryBinding(node):
+    # libc and the syscall are resolved by pyrunlim, and the returned function is called in the
+    # child before exec: dlopen in the child of a multi-threaded process may deadlock
+    (syscall, number) = resolveSyscall("set_mempolicy")
+    MPOL_BIND = 2
+    mask = (ctypes.c_ulong * (node // 64 + 1))()
+    mask[node // 64] = 1 << (node % 64)
+    return lambda: syscall(number, MPOL_BIND, mask, len(mask) * 64)
+
+def parseCpuList(cpulist):
+    res = []
+    for item in cpulist.strip().split(","):
+        if "-" in item:
+            (first, last) = item.split("-")
+            res.extend(range(int(first), int(last) + 1))
+        elif item:
+            res.append(int(item))
+    return res
+
+def numaNodes():
+    res = {}
+    directory = "/sys/devices/system/node"
+    for node in sorted(os.listdir(directory) if os.path.isdir(directory) else []):
+        if node.startswith("node") and node[4:].isdigit():
+            with open(os.path.join(directory, node, "cpulist")) as f:
+                res[int(node[4:])] = parseCpuList(f.read())
+    return res
+
+def perfEventOpen(pid, type, config, excludeKernel):
+    PERF_FORMAT_TOTAL_TIME_ENABLED = 1
+    PERF_FORMAT_TOTAL_TIME_RUNNING = 2
+    PERF_FLAG_FD_CLOEXEC = 8
+    # disabled, inherit, exclude_kernel and exclude_hv (if requested), enable_on_exec
+    flags = 1 | 2 | (32 | 64 if excludeKernel else 0) | 4096
+    attr = ctypes.create_string_buffer(struct.pack("IIQQQQQ", type, 128, config, 0, 0, PERF_FORMAT_TOTAL_TIME_ENABLED | PERF_FORMAT_TOTAL_TIME_RUNNING, flags), 128)
+    (syscall, number) = resolveSyscall("perf_event_open")
+    fd = syscall(number, attr, pid, -1, -1, PERF_FLAG_FD_CLOEXEC)
+    if fd < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return fd
+
+class PerfCounters:
+    EVENTS = [("instructions", 0, 1), ("cycles", 0, 0), ("llc-misses", 3, 0x10002), ("context-switches", 1, 3)]
+
+    def __init__(self):
+        # the child sends its pid and waits before exec, while pyrunlim opens the counters on it
+        self.request = os.pipe()
+        self.ready = os.pipe()
+        self.fds = {}
+        self.values = {}
+        self.scope = "unavailable"
+        self.errors = {}
+        self.thread = threading.Thread(target=self._open, daemon=True)
+        self.thread.start()
+
+    def preexec(self):
+        # called in the child before exec: only pipes are used here, since dlopen and friends in the
+        # child of a multi-threaded process may deadlock
+        os.write(self.request[1], struct.pack("=i", os.getpid()))
+        os.read(self.ready[0], 1)
+
+    def _open(self):
+        # counters are enabled by the exec, and follow the command and its descendants from then on
+        try:
+            data = os.read(self.request[0], 4)
+            if len(data) < 4:
+                return
+            pid = struct.unpack("=i", data)[0]
+            scope = None
+            for (name, type, config) in PerfCounters.EVENTS:
+                for excludeKernel in ([False, True] if scope == None else [scope == "user"]):
+                    try:
+                        self.fds[name] = perfEventOpen(pid, type, config, excludeKernel)
+                        scope = "user" if excludeKernel else "all"
+                        break
+                    except OSError as e:
+                        self.errors[name] = str(e)
+            if scope != None:
+                self.scope = scope
+        finally:
+            os.write(self.ready[1], b"\0")
+
+    def receive(self):
+        # called after the spawn (or its failure): the write end of the request pipe is closed, so
+        # that the thread stops if the child did not get to preexec
+        os.close(self.request[1])
+        self.thread.join()
+        for fd in (self.request[0], self.ready[0], self.ready[1]):
+            os.close(fd)
+
+    def read(self):
+        for (name, fd) in self.fds.items():
+            try:
+                (value, enabled, running) = struct.unpack("QQQ", os.read(fd, 24))
+                # scale counters multiplexed with other events
+                self.values[name] = value if running in (0, enabled) else int(value * enabled / running)
+            except (OSError, struct.error):
+                pass
+            os.close(fd)
+        self.fds = {}
+
+class Future:
+    def __init__(self):
+        self.value = None
+        self.isDone = False
+
+    def done(self):
+        return self.isDone
+
+    def set_result(self, value):
+        self.value = value
+        self.isDone = True
+
+    def result(self):
+        return self.value
+
+class Handle:
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop:
+    # the small subset of asyncio used by Process (readers, timers and wakeups from other threads),
+    # on top of selectors: asyncio alone takes longer to import than many commands take to run
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.sequence = 0
+        self.ready = collections.deque()
+        self.lock = threading.Lock()
+        self.running = False
+        self.closed = False
+        self.writable = {}
+        self.wakeup = os.pipe()
+        os.set_blocking(self.wakeup[0], False)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, None)
+
+    def create_future(self):
+        return Future()
+
+    def add_reader(self, fd, callback, *args):
+        self.selector.register(fd, selectors.EVENT_READ, Handle(callback, args))
+
+    def remove_reader(self, fd):
+        self.selector.unregister(fd)
+
+    def call_when_writable(self, fd, callback, *args):
+        # one-shot: several callbacks may wait for the same fd (e.g., output and error redirected together)
+        if fd not in self.writable:
+            self.writable[fd] = []
+            self.selector.register(fd, selectors.EVENT_WRITE, Handle(self._onWritable, (fd,)))
+        self.writable[fd].append(Handle(callback, args))
+
+    def _onWritable(self, fd):
+        self.selector.unregister(fd)
+        for handle in self.writable.pop(fd):
+            handle.callback(*handle.args)
+
+    def call_later(self, delay, callback, *args):
+        handle = Handle(callback, args)
+        self.sequence = self.sequence + 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.sequence, handle))
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self.lock:
+            if self.closed:
+                return
+            self.ready.append(Handle(callback, args))
+            os.write(self.wakeup[1], b"\0")
+
+    def run_until(self, condition):
+        self.running = True
+        while not condition():
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.monotonic())
+            for (key, events) in self.selector.select(timeout):
+                if key.data == None:
+                    try:
+                        os.read(self.wakeup[0], 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    key.data.callback(*key.data.args)
+            with self.lock:
+                ready = list(self.ready)
+                self.ready.clear()
+            for handle in ready:
+                handle.callback(*handle.args)
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                handle = heapq.heappop(self.timers)[2]
+                if not handle.cancelled:
+                    handle.callback(*handle.args)
+        self.running = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.selector.close()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+class Reaper:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.spawned = 0
+        self.wrappers = {}
+        self.active = set()
+        self.thread = None
+
+    def spawn(self, process, spawn):
+        with self.condition:
+            res = spawn()
+            process.process = res
+            self.wrappers[res.pid] = process
+            self.active.add(process)
+            self.spawned = self.spawned + 1
+            self.condition.notify()
+            if self.thread == None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return res
+
+    def owns(self, process):
+        return len(self.children(process)) > 0
+
+    def children(self, process):
+        with self.condition:
+            return [pid for pid in self._children() if self._owner(pid) is process]
+
+    def unregister(self, process):
+        with self.condition:
+            self.active.discard(process)
+            for pid in [pid for pid in self.wrappers if self.wrappers[pid] is process]:
+                del self.wrappers[pid]
+
+    def _children(self):
+        res = []
+        for tid in os.listdir("/proc/self/task"):
+            try:
+                with open("/proc/self/task/%s/children" % tid) as f:
+                    res.extend([int(pid) for pid in f.read().split()])
+            except OSError:
+                pass
+        return res
+
+    def _owner(self, pid):
+        if pid in self.wrappers:
+            return self.wrappers[pid]
+        for process in self.active:
+            if pid in process.subprocesses or process.backend.owns(pid):
+                return process
+        if len(self.active) == 1:
+            return next(iter(self.active))
+        # an orphan that was never sampled: commands running in parallel have their own process
+        # group, whose id is the pid of their wrapper (see Batch)
+        return self.wrappers.get(procGroup(pid))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                spawned = self.spawned
+            try:
+                info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                with self.condition:
+                    while self.spawned == spawned:
+                        self.condition.wait()
+                continue
+            with self.condition:
+                owner = self._owner(info.si_pid)
+            if owner != None:
+                owner._exiting(info.si_pid)
+            # no process is spawned (see spawn) until the owner knows that the pid is free
+            with self.condition:
+                (pid, status, rusage) = os.wait4(info.si_pid, 0)
+                if owner != None:
+                    owner._reaped(pid, status, rusage)
+
+reaper = Reaper()
 
 class Process:
     def __init__(self):
@@ -328,8 +1723,30 @@ class Process:
         self.realtimelimit = 10**100
         self.timelimit = 10**100
         self.memorylimit = 10**100
+        self.softrealtimelimit = 10**100
+        self.softtimelimit = 10**100
+        self.softmemorylimit = 10**100
+        self.graceSignal = signal.SIGTERM
+        self.grace = 10
+        self.softLimit = None
+        self.softLimitReal = None
+        self.softLimitLines = 0
+        self.graceEndLines = None
+        self.graceHandle = None
         self.swaplimit = 10**100
+        self.ioreadlimit = 10**100
+        self.iowritelimit = 10**100
+        self.accounting = "cheap"
+        self.tracking = "auto"
         self.log = sys.stderr
+        self.closeLog = False
+        self.job = None
+        self.slot = None
+        self.memoryNode = None
+        self.memoryBinding = None
+        self.processGroup = False
+        self.kernelLimits = False
+        self.kernelMemoryLimit = "data"
         self.redirectOutput = "/dev/stdout"
         self.redirectError = "/dev/stdout"
         self.stdoutFile = sys.stdout
@@ -337,16 +1754,45 @@ class Process:
         self.timestamp = True
         self.printLastSample = True
         self.printLine = True
+        self.maxLineLength = 1048576
+        self.passthrough = False
         self.regexes = []
+        self.extractor = RegexExtractor([])
         
-        self.affinity = psutil.Process(os.getpid()).cpu_affinity()
+        self.affinity = sorted(os.sched_getaffinity(0))
+        self.backendName = "auto"
+        self.backend = None
         self.nice = 20
         
+        self.sampling = "fixed"
+        self.profile = None
+        self.profileInterval = .1
+        self.perf = False
+        self.perfCounters = None
+        self.selfBenchmark = False
+        self.startupBudget = None
+        self.argv = None
+        self.metricsSocket = None
+        self.metricsFormat = "json"
+        self.metrics = None
+        self.calibrationFile = None
+        self.calibration = None
+        self.benchmark = {"imports": IMPORT_TIME}
+        self.loop = None
         self.samplings = 0
+        self.samplingDelay = SAMPLING_MIN_DELAY
+        self.samplingRates = None
+        self.timeOvershoot = 0
+        self.memoryOvershoot = 0
+        self.samplingTime = 0
+        self.samplingCpuTime = 0
         self.reportFrequency = 10
         self.numberOfReports = 0
         self.status = "interrupted"
+        self.enforcedBy = None
         self.result = None
+        self.rootExited = False
+        self.killing = None
         self.exit_code = None
         
         self.real = 0
@@ -356,29 +1802,246 @@ class Process:
         self.rss = 0
         self.swap = 0
         self.max_memory = 0
+        self.read = 0
+        self.write = 0
+        self.io = False
+        self.ioBase = (0, 0)
+        self.files = 0
+        self.max_files = 0
+        self.oomKills = 0
+        self.swapFailures = 0
         
         self.subprocesses = {}
+        self.bytes = {"stdout": 0, "stderr": 0}
+        self.lines = {"stdout": 0, "stderr": 0}
+        
+        self.subreaper = False
+        self.reaped = 0
+        self.exact_user = 0
+        self.exact_system = 0
+        self.exact_max_memory = 0
     
-    def setPyrunlimAffinity(self, value):
-        psutil.Process(os.getpid()).cpu_affinity(value)
-    
-    def _readOutputStream(self):
-        while True:
-            line = self.process.stdout.readline().decode()
-            if not line:
-                break
-            real = time.time() - self.begin
-            self.output.reportOutputStream(real, line if line[-1] != '\n' else line[:-1], (self.real, self.user, self.system, self.max_memory, self.rss, self.swap))
+    def _readStream(self, name, fd, report, write, done):
+        data = os.read(fd, 65536)
+        real = time.time() - self.begin
+        self.bytes[name] = self.bytes[name] + len(data)
+        if self.long[fd] != None:
+            end = data.find(b"\n")
+            self._continueLongLine(fd, real, data if end == -1 else data[:end], write)
+            if end == -1 and data:
+                return
+            self.lines[name] = self.lines[name] + 1
+            report(real, [self._endLongLine(fd, real, write)], (self.real, self.user, self.system, self.max_memory, self.rss, self.swap, self.read, self.write), self.long[fd]["size"])
+            self.long[fd] = None
+            if end != -1 and end == len(data) - 1:
+                return
+            data = data[end + 1:]
+        if not data:
+            self.loop.remove_reader(fd)
+            if self.partial[fd]:
+                self.lines[name] = self.lines[name] + 1
+                report(real, [self.partial[fd].decode(errors="replace")], (self.real, self.user, self.system, self.max_memory, self.rss, self.swap, self.read, self.write))
+            done.set_result(None)
+            return
+        lines = (self.partial[fd] + data).split(b"\n")
+        self.partial[fd] = lines.pop()
+        self.lines[name] = self.lines[name] + len(lines)
+        while lines:
+            count = 0
+            while count < len(lines) and len(lines[count]) <= self.maxLineLength:
+                count = count + 1
+            if count > 0:
+                report(real, [line.decode(errors="replace") for line in lines[:count]], (self.real, self.user, self.system, self.max_memory, self.rss, self.swap, self.read, self.write))
+            if count < len(lines):
+                self._startLongLine(fd, real, lines[count], write)
+                report(real, [self._endLongLine(fd, real, write)], (self.real, self.user, self.system, self.max_memory, self.rss, self.swap, self.read, self.write), self.long[fd]["size"])
+                self.long[fd] = None
+                count = count + 1
+            lines = lines[count:]
+        if len(self.partial[fd]) > self.maxLineLength:
+            self._startLongLine(fd, real, self.partial[fd], write)
+            self.partial[fd] = b""
 
-    def _readErrorStream(self):
-        while True:
-            line = self.process.stderr.readline().decode()
-            if not line:
-                break
-            real = time.time() - self.begin
-            self.output.reportErrorStream(real, line if line[-1] != '\n' else line[:-1], (self.real, self.user, self.system, self.max_memory, self.rss, self.swap))
+    def _startLongLine(self, fd, real, data, write):
+        self.long[fd] = {"head": data[:self.maxLineLength // 2], "tail": b"", "size": 0, "decoder": codecs.getincrementaldecoder("utf-8")(errors="replace")}
+        self._continueLongLine(fd, real, data, write)
+
+    def _continueLongLine(self, fd, real, data, write):
+        # only the head and the tail of a long line are kept in memory
+        line = self.long[fd]
+        line["tail"] = (line["tail"] + data)[-(self.maxLineLength // 2):]
+        write(real, line["decoder"].decode(data), line["size"] == 0)
+        line["size"] = line["size"] + len(data)
+
+    def _endLongLine(self, fd, real, write):
+        line = self.long[fd]
+        write(real, line["decoder"].decode(b"", True), False)
+        return "%s[... %d bytes ...]%s" % (line["head"].decode(errors="replace"), line["size"] - len(line["head"]) - len(line["tail"]), line["tail"].decode(errors="replace"))
+
+    def _passStream(self, name, fd, out, done):
+        try:
+            if self.splice[fd]:
+                count = os.splice(fd, out, 1 << 20, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                self.lines[name] = None
+            else:
+                data = os.read(fd, 1 << 16)
+                count = len(data)
+                if self.lines[name] != None:
+                    self.lines[name] = self.lines[name] + data.count(b"\n")
+                    self.partial[fd] = data[-1:] if data else self.partial[fd]
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(out, view):]
+        except BlockingIOError:
+            if self.splice[fd]:
+                # the output is full (e.g., a pipe read slowly): wait for it rather than retrying at once
+                self.loop.remove_reader(fd)
+                self.loop.call_when_writable(out, self.loop.add_reader, fd, self._passStream, name, fd, out, done)
+            return
+        except OSError:
+            if not self.splice[fd]:
+                raise
+            self.splice[fd] = False
+            return
+        self.bytes[name] = self.bytes[name] + count
+        if count == 0:
+            self.loop.remove_reader(fd)
+            if self.lines[name] != None and self.partial[fd] not in (b"", b"\n"):
+                self.lines[name] = self.lines[name] + 1
+            done.set_result(None)
+
+    def _scheduleSampler(self):
+        self.count = self.count + 1
+        if self.sampling == "adaptive":
+            delay = self._adaptiveDelay()
+        elif self.count < 10:
+            delay = .1
+        elif self.count < 30:
+            delay = .2
+        elif self.count < 60:
+            delay = .5
+        else:
+            delay = 1
+        self.samplerHandle = self.loop.call_later(delay, self._onSampler)
+
+    def _adaptiveDelay(self):
+        # next sample within a fraction of the time needed to reach the closest limit at the recent
+        # peak rate (decaying over time), and more often when memory or swap are close to their limits
+        usage = (self.real, self.user + self.system, self.max_memory, self.swap, self.read, self.write)
+        limits = (self.realtimelimit, self.timelimit, self.memorylimit, self.swaplimit, self.ioreadlimit, self.iowritelimit)
+        if self.softLimit == None:
+            limits = (min(limits[0], self.softrealtimelimit), min(limits[1], self.softtimelimit), min(limits[2], self.softmemorylimit)) + limits[3:]
+        delay = min(SAMPLING_MAX_DELAY, 2 * self.samplingDelay)
+        if self.samplingRates == None:
+            self.samplingRates = [1, 0, 0, 0, 0, 0]
+        else:
+            elapsed = max(usage[0] - self.samplingUsage[0], SAMPLING_MIN_DELAY)
+            decay = .5 ** (elapsed / SAMPLING_RATE_HALF_LIFE)
+            for i in range(1, 6):
+                self.samplingRates[i] = max((usage[i] - self.samplingUsage[i]) / elapsed, self.samplingRates[i] * decay)
+        self.samplingUsage = usage
+        if self.exit_code == None:
+            for i in range(6):
+                if self.samplingRates[i] > 0:
+                    delay = min(delay, (limits[i] - usage[i]) / self.samplingRates[i] / 4)
+            for i in range(2, 4):
+                delay = min(delay, SAMPLING_MAX_DELAY * (limits[i] - usage[i]) / limits[i])
+        self.samplingDelay = max(SAMPLING_MIN_DELAY, delay)
+        return self.samplingDelay
+
+    def _onSampler(self):
+        self._sampler()
+        self._checkExited()
+        self._scheduleSampler()
+
+    def _onProfiler(self):
+        self.profile.sample(time.time() - self.begin, self.backend.pids())
+        self.profilerHandle = self.loop.call_later(self.profileInterval, self._onProfiler)
+
+    def _openMetrics(self):
+        # a stale socket (left by a killed pyrunlim) is replaced, but a live one is not; the command
+        # runs anyway if the socket cannot be served
+        try:
+            if stat.S_ISSOCK(os.stat(self.metricsSocket).st_mode):
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    probe.connect(self.metricsSocket)
+                print("pyrunlim: warning: metrics socket %s is in use, metrics are not served" % self.metricsSocket, file=sys.stderr)
+                return
+        except ConnectionRefusedError:
+            try:
+                os.unlink(self.metricsSocket)
+            except OSError:
+                pass
+        except OSError:
+            pass
+        metrics = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            metrics.bind(self.metricsSocket)
+            metrics.listen(16)
+        except OSError as e:
+            metrics.close()
+            print("pyrunlim: warning: cannot serve metrics on %s (%s), metrics are not served" % (self.metricsSocket, e.strerror), file=sys.stderr)
+            return
+        metrics.setblocking(False)
+        self.metrics = metrics
+        self.loop.add_reader(self.metrics.fileno(), self._onMetrics)
+
+    def _closeMetrics(self):
+        self.loop.remove_reader(self.metrics.fileno())
+        self.metrics.close()
+        self.metrics = None
+        try:
+            os.unlink(self.metricsSocket)
+        except FileNotFoundError:
+            pass
+
+    def _onMetrics(self):
+        try:
+            (client, address) = self.metrics.accept()
+        except BlockingIOError:
+            return
+        with client:
+            # a snapshot fits in the buffer of the socket: the loop never waits for slow clients
+            client.setblocking(False)
+            try:
+                client.send(self._metricsSnapshot().encode())
+            except OSError:
+                pass
+
+    def _metricsSnapshot(self):
+        values = [("real", self.real, "seconds"), ("user", self.user, "seconds"), ("sys", self.system, "seconds"), ("max-memory", self.max_memory, "megabytes"), ("rss", self.rss, "megabytes"), ("swap", self.swap, "megabytes"), ("read", self.read, "megabytes"), ("write", self.write, "megabytes"), ("children", len(self.subprocesses), None), ("stdout-lines", self.lines["stdout"], None), ("stderr-lines", self.lines["stderr"], None), ("samples", self.samplings, None)]
+        if self.metricsFormat == "json":
+            record = {"version": VERSION, "pid": self.process.pid, "status": "running" if self.exit_code == None else self.status}
+            if self.job != None:
+                record["job"] = self.job
+            for (key, value, unit) in values:
+                record[key] = round(value, 3 if unit == "seconds" else 1) if unit != None else value
+            return json.dumps(record, separators=(",", ":")) + "\n"
+        labels = "" if self.job == None else '{job="%s"}' % str(self.job).replace("\\", "\\\\").replace('"', '\\"')
+        res = []
+        for (key, value, unit) in values:
+            if value == None:
+                # e.g., lines are not counted by --passthrough with splice
+                continue
+            name = "pyrunlim_%s%s" % (key.replace("-", "_"), "" if unit == None else "_" + unit)
+            res.append("# TYPE %s gauge\n%s%s %s\n" % (name, name, labels, value))
+        res.append("# TYPE pyrunlim_running gauge\npyrunlim_running%s %d\n" % (labels, self.exit_code == None))
+        return "".join(res)
+
+    def wrapper(self):
+        return "bash" if self.argv == None else "direct"
+
+    def running(self):
+        if self.argv != None:
+            return " ".join(self.args)
+        return 'bash -c "%s"' % " ".join(self.args).replace('"', '\\"')
 
     def run(self):
+        if self.calibrationFile != None:
+            self.calibration = Calibration(self.calibrationFile).load(self.wrapper())
+        self.extractor = RegexExtractor(self.regexes)
+        self.subreaper = setChildSubreaper()
+        self.backend = createBackend(self)
         self.output.begin()
         self.begin = time.time()
         
@@ -395,103 +2058,206 @@ class Process:
             else:
                 self.stderrFile = self.stdoutFile
 
-        self.process = psutil.Popen(["bash", "-c", "PYTHONHASHSEED=0 trap '' SIGINT SIGTERM; (%s)" % (" ".join(self.args),)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        self.process.nice(self.nice)
-        self.process.cpu_affinity(self.affinity)
-        
-        stdoutReader = threading.Thread(target=self._readOutputStream)
-        stderrReader = threading.Thread(target=self._readErrorStream)
-        stdoutReader.start()
-        stderrReader.start()
-        
-        waiter = threading.Thread(target=self._wait)
-        waiter.start()
-        count = 0
-        while waiter.is_alive():
-            count = count + 1
-            if count < 10:
-                time.sleep(.1)
-            elif count < 30:
-                time.sleep(.2)
-            elif count < 60:
-                time.sleep(.5)
-            else:
-                time.sleep(1)
-            self._sampler()
-        waiter.join()
+        self.loop = EventLoop()
+        try:
+            if self.metricsSocket != None:
+                self._openMetrics()
+            self._run()
+        finally:
+            if self.metrics != None:
+                self._closeMetrics()
+            self.loop.close()
+        self.backend.finish()
+        self._reapOrphans()
+        if self.perfCounters != None:
+            self.perfCounters.read()
 
+        if self.exit_code == None:
+            self._checkKernelLimit()
+        if self.exit_code == None:
+            self._checkResourceLimit()
         if self.exit_code == None:
             self.status = "complete"
             self.exit_code = 0
-        
-        stdoutReader.join()
-        stderrReader.join()
+        if self.selfBenchmark:
+            self.benchmark["teardown"] = time.perf_counter() - self.exitedAt
         
         self.output.end()
+        if self.overStartupBudget():
+            print("pyrunlim: warning: startup took %.1f ms, over the budget of %.1f ms" % (1000 * self.benchmark["startup"], self.startupBudget), file=sys.stderr)
+        if self.profile != None:
+            self.profile.write()
 
         if self.stdoutFile != sys.stdout and self.stdoutFile != sys.stderr:
             self.stdoutFile.close()
         if self.stderrFile != sys.stdout and self.stderrFile != sys.stderr and self.redirectError != self.redirectOutput:
             self.stderrFile.close()
-        if self.log != sys.stdout and self.log != sys.stderr:
+        if self.closeLog:
             self.log.close()
-            
-    def _wait(self):
-        self.result = self.process.wait()
-        
-    def kill(self):
-        try:
-            subprocesses = self.process.children(recursive=True)
-        except psutil.NoSuchProcess:
-            subprocesses = []
-        subprocesses = [p for p in subprocesses if p.cmdline != self.process.cmdline]
 
-        for p in subprocesses:
-            try:
-                p.terminate()
-            except psutil.NoSuchProcess:
-                pass
+    def _run(self):
+        self.exited = self.loop.create_future()
+        stdoutDone = self.loop.create_future()
+        stderrDone = self.loop.create_future()
 
-        gone, alive = psutil.wait_procs(subprocesses, timeout=10)
-        for p in alive:
-            try:
-                p.kill()
-            except psutil.NoSuchProcess:
-                pass
+        if self.perf:
+            self.perfCounters = PerfCounters()
+        if self.memoryNode != None:
+            self.memoryBinding = memoryBinding(self.memoryNode)
+        if self.argv != None:
+            (command, env) = (self.argv, dict(os.environ, PYTHONHASHSEED="0"))
+        else:
+            (command, env) = (["bash", "-c", "PYTHONHASHSEED=0 trap '' SIGINT SIGTERM; (%s)" % (" ".join(self.args),)], None)
+        self.process = reaper.spawn(self, lambda: self.backend.spawn(lambda: subprocess.Popen(command, stdin=subprocess.DEVNULL if self.processGroup else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, preexec_fn=self._preexec)))
+        if self.perfCounters != None:
+            self.perfCounters.receive()
+        if self.selfBenchmark:
+            self.benchmark["startup"] = time.perf_counter() - START_TIME
+        os.setpriority(os.PRIO_PROCESS, self.process.pid, self.nice)
+        os.sched_setaffinity(self.process.pid, self.affinity)
 
-    def _updateResourceUsage(self):
-        subprocesses = [self.process]
+        self.partial = {}
+        self.long = {}
+        self.splice = {}
+        for (name, stream, report, write, out, done) in (("stdout", self.process.stdout, self.output.reportOutputStream, self.output.writeOutputStream, self.stdoutFile, stdoutDone), ("stderr", self.process.stderr, self.output.reportErrorStream, self.output.writeErrorStream, self.stderrFile, stderrDone)):
+            os.set_blocking(stream.fileno(), False)
+            self.partial[stream.fileno()] = b""
+            self.long[stream.fileno()] = None
+            if self.passthrough:
+                out.flush()
+                self.splice[stream.fileno()] = hasattr(os, "splice")
+                self.loop.add_reader(stream.fileno(), self._passStream, name, stream.fileno(), out.fileno(), done)
+            else:
+                self.loop.add_reader(stream.fileno(), self._readStream, name, stream.fileno(), report, write, done)
+
+        self.count = 0
+        self._scheduleSampler()
+        if self.profile != None:
+            self._onProfiler()
+        self.loop.run_until(self.exited.done)
+        self.exitedAt = time.perf_counter()
+        self.samplerHandle.cancel()
+        if self.profile != None:
+            self.profilerHandle.cancel()
+        if self.graceHandle != None:
+            self.graceHandle.cancel()
+        # a command stopped by an rlimit is over the limit also in the last sample, which must not
+        # ascribe the kill to the sampler
+        if self.exit_code == None:
+            self._checkResourceLimit()
+        self._sampler()
+
+        self.loop.run_until(lambda: stdoutDone.done() and stderrDone.done())
+        self.process.stdout.close()
+        self.process.stderr.close()
+
+    def _preexec(self):
+        self.backend.preexec()
+        if self.argv != None:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        if self.processGroup:
+            os.setpgid(0, 0)
+        if self.memoryBinding != None:
+            self.memoryBinding()
+        if self.perfCounters != None:
+            self.perfCounters.preexec()
+        if self.kernelLimits:
+            if self.timelimit < 10**100:
+                resource.setrlimit(resource.RLIMIT_CPU, (self.timelimit, self.timelimit + 1))
+            if self.memorylimit < 10**100:
+                limit = self.memorylimit * 1024 * 1024
+                resource.setrlimit(resource.RLIMIT_DATA if self.kernelMemoryLimit == "data" else resource.RLIMIT_AS, (limit, limit))
+
+    def _reapOrphans(self, timeout=1):
+        deadline = time.time() + timeout
+        while time.time() < deadline and reaper.owns(self):
+            time.sleep(.01)
+        reaper.unregister(self)
+
+    def _exiting(self, pid):
+        if not self.io:
+            return
+        subprocess = self.subprocesses.get(pid)
         try:
-            subprocesses.extend(self.process.children(recursive=True))
-        except psutil.NoSuchProcess:
-            pass
-        
-        rss = 0
-        swap = 0
-        for p in subprocesses:
-            if p.pid not in self.subprocesses:
-                self.subprocesses[p.pid] = Subprocess()
-                    
-            try:
-                self.subprocesses[p.pid].update(p.cpu_times(), p.memory_info(), p.memory_maps())
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
-            
-            rss = rss + self.subprocesses[p.pid].rss
-            swap = swap + self.subprocesses[p.pid].swap
+            (read, write) = readProcIo(pid)
+        except (OSError, KeyError, ValueError):
+            (read, write) = (0, 0) if subprocess == None else (subprocess.read, subprocess.write)
+        if subprocess != None:
+            subprocess.exited = True
+        self.ioBase = (self.ioBase[0] + read, self.ioBase[1] + write)
+
+    def _reaped(self, pid, status, rusage):
+        self.reaped = self.reaped + 1
+        self.exact_user = self.exact_user + rusage.ru_utime
+        self.exact_system = self.exact_system + rusage.ru_stime
+        if rusage.ru_maxrss / 1024 > self.exact_max_memory:
+            self.exact_max_memory = rusage.ru_maxrss / 1024
+        if pid == self.process.pid:
+            self.result = os.waitstatus_to_exitcode(status)
+            # the child of Popen was reaped by the reaper: its poll gets ECHILD and marks the child as
+            # gone (with no fork in between, see Reaper), so that Popen never waits for a reused pid
+            self.process.poll()
+            self.rootExited = True
+        if self.rootExited:
+            self.loop.call_soon_threadsafe(self._checkExited)
 
-        self.rss = rss / 1024 / 1024
-        self.swap = swap / 1024 / 1024
+    def _checkExited(self):
+        # the command is over when the root process and all of its descendants have exited:
+        # processes left behind by the root are still sampled and limited
+        if self.rootExited and not self.exited.done() and not any([procAlive(pid) for pid in self.commandPids() + reaper.children(self)]):
+            self.exited.set_result(None)
 
-        if self.rss + self.swap > self.max_memory:
-            self.max_memory = self.rss + self.swap
+    def commandPids(self):
+        # the processes of the command, i.e., all but the bash wrapper
+        return [pid for pid in self.backend.pids() if self.argv != None or pid != self.process.pid]
+        
+    def kill(self, graceful=True):
+        if self.backend == None:
+            return
+        # each sample over a limit calls kill: the processes are killed once, unless an immediate
+        # kill follows a graceful one (e.g., at the end of the grace period of a soft limit)
+        if self.killing == "immediate" or (self.killing == "graceful" and graceful):
+            return
+        self.killing = "graceful" if graceful else "immediate"
+        if not graceful and self.softLimit != None:
+            # what the command prints once killed (e.g., "Killed" by bash) is not printed during grace
+            self.graceEndLines = self.countLines()
+        if self.loop != None and self.loop.running:
+            threading.Thread(target=self.backend.kill, args=(graceful,), daemon=True).start()
+        else:
+            self.backend.kill(graceful)
 
+    def _updateResourceUsage(self):
+        begin = (time.perf_counter(), time.thread_time())
+        self.backend.update()
+        if self.io:
+            self._updateIo()
+        self.samplingTime = self.samplingTime + time.perf_counter() - begin[0]
+        self.samplingCpuTime = self.samplingCpuTime + time.thread_time() - begin[1]
         self.real = time.time() - self.begin
-        self.user = 0
-        self.system = 0
-        for p in self.subprocesses:
-            self.user = self.user + self.subprocesses[p].user
-            self.system = self.system + self.subprocesses[p].system
+
+    def _updateIo(self):
+        # the counters of a process include those of the children it reaped, and the counters of
+        # processes reaped by pyrunlim are added to ioBase (see _exiting)
+        (read, write) = self.ioBase
+        files = 0
+        for pid in self.backend.pids():
+            subprocess = self.subprocesses.get(pid)
+            if subprocess == None or subprocess.exited:
+                continue
+            try:
+                (subprocess.read, subprocess.write) = readProcIo(pid)
+                subprocess.files = len(os.listdir("/proc/%d/fd" % pid))
+            except (OSError, KeyError, ValueError):
+                pass
+            read = read + subprocess.read
+            write = write + subprocess.write
+            files = files + subprocess.files
+        self.read = max(self.read, read / 1024 / 1024)
+        self.write = max(self.write, write / 1024 / 1024)
+        self.files = files
+        self.max_files = max(self.max_files, files)
 
     def _sampler(self):
         self._updateResourceUsage()
@@ -504,6 +2270,9 @@ class Process:
         self._checkLimit()
     
     def _checkLimit(self):
+        if self.exit_code == None:
+            self.timeOvershoot = max(self.timeOvershoot, self.real - self.realtimelimit, self.user + self.system - self.timelimit)
+            self.memoryOvershoot = max(self.memoryOvershoot, self.max_memory - self.memorylimit, self.swap - self.swaplimit)
         if self.real > self.realtimelimit:
             self.status = "out of time (real)"
             self.exit_code = 1
@@ -520,10 +2289,324 @@ class Process:
             self.status = "out of memory (swap)"
             self.exit_code = 4
             self.kill()
+        elif self.read > self.ioreadlimit:
+            self.status = "out of io (read)"
+            self.exit_code = 6
+            self.kill()
+        elif self.write > self.iowritelimit:
+            self.status = "out of io (write)"
+            self.exit_code = 6
+            self.kill()
+        else:
+            self._checkKernelLimit()
+            if self.exit_code == None and self.softLimit == None and not self.exited.done():
+                self._checkSoftLimit()
+        if self.exit_code != None and self.enforcedBy == None:
+            self.enforcedBy = "sampler"
+
+    def _checkSoftLimit(self):
+        if self.real > self.softrealtimelimit:
+            self.softLimit = "real-time"
+        elif self.user + self.system > self.softtimelimit:
+            self.softLimit = "time"
+        elif self.max_memory > self.softmemorylimit:
+            self.softLimit = "memory"
+        else:
+            return
+        self.softLimitReal = self.real
+        self.softLimitLines = self.countLines()
+        for pid in self.commandPids():
+            try:
+                os.kill(pid, self.graceSignal)
+            except ProcessLookupError:
+                pass
+        self.graceHandle = self.loop.call_later(self.grace, self._onGrace)
+
+    def _onGrace(self):
+        # hard limit of the resource whose soft limit was reached
+        if self.exit_code != None or self.exited.done():
+            return
+        (self.status, self.exit_code) = {"real-time": ("out of time (real)", 1), "time": ("out of time", 2), "memory": ("out of memory", 3)}[self.softLimit]
+        self.enforcedBy = "grace"
+        self.kill(graceful=False)
+
+    def overStartupBudget(self):
+        return self.startupBudget != None and 1000 * self.benchmark["startup"] > self.startupBudget
+
+    def hasSoftLimits(self):
+        return min(self.softtimelimit, self.softmemorylimit, self.softrealtimelimit) < 10**100
+
+    def countLines(self):
+        # lines are not counted by --passthrough with splice
+        if self.lines["stdout"] == None or self.lines["stderr"] == None:
+            return None
+        return self.lines["stdout"] + self.lines["stderr"]
+
+    def graceLines(self):
+        end = self.countLines() if self.graceEndLines == None else self.graceEndLines
+        if end == None or self.softLimitLines == None:
+            return None
+        return end - self.softLimitLines
+
+    def _checkKernelLimit(self):
+        # swap allocations failed at memory.swap.max before the oom kill: swap was the limit reached
+        if self.oomKills > 0 and self.swapFailures > 0:
+            self.status = "out of memory (swap)"
+            self.exit_code = 4
+            self.enforcedBy = "cgroup"
+            self.kill()
+        elif self.oomKills > 0:
+            self.status = "out of memory"
+            self.exit_code = 3
+            self.enforcedBy = "cgroup"
+            self.kill()
+
+    def _checkResourceLimit(self):
+        # rlimits leave no record: a process killed by SIGXCPU (or exiting with bash's 128 + signal)
+        # was stopped by RLIMIT_CPU, and so was one killed by SIGKILL after using the cpu time limit
+        # (the rusage of a process killed by SIGXCPU may be a few ms short of the limit); a process
+        # killed by the signals of a failed allocation (SIGSEGV, SIGBUS, SIGABRT for uncaught
+        # std::bad_alloc, SIGKILL) close to the memory limit was stopped by RLIMIT_DATA or RLIMIT_AS;
+        # any other exit code is the one of the command (e.g., 10, 20 or 30 for sat solvers)
+        if not self.kernelLimits or not self.result:
+            return
+        if self.timelimit < 10**100 and (self.result in (-signal.SIGXCPU, 128 + signal.SIGXCPU) or (self.exact_user + self.exact_system >= self.timelimit and self.result in (-signal.SIGKILL, 128 + signal.SIGKILL))):
+            self.status = "out of time"
+            self.exit_code = 2
+            self.enforcedBy = "kernel"
+        elif max(self.max_memory, self.exact_max_memory) >= RLIMIT_MEMORY_THRESHOLD * self.memorylimit and self.result in [-signum for signum in RLIMIT_MEMORY_SIGNALS] + [128 + signum for signum in RLIMIT_MEMORY_SIGNALS]:
+            self.status = "out of memory"
+            self.exit_code = 3
+            self.enforcedBy = "kernel"
             
+class Calibration:
+    def __init__(self, filename):
+        self.filename = filename
+        self.host = os.uname().nodename
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self, wrapper):
+        # the overhead of a wrapper is what it costs more than running the command directly:
+        # the cost of true itself, and of fork and exec, is part of any run
+        data = self._read().get(self.host, {})
+        if wrapper not in data or "direct" not in data:
+            return None
+        return dict((key, max(0, data[wrapper][key] - data["direct"][key])) for key in ("real", "user", "system"))
+
+    def measure(self, runs):
+        res = {}
+        for wrapper in ("bash", "direct"):
+            values = []
+            for i in range(runs):
+                process = Process()
+                process.log = open(os.devnull, "w")
+                process.closeLog = True
+                process.args = ["true"]
+                if wrapper == "direct":
+                    process.argv = ["true"]
+                process.run()
+                values.append((process.real, process.exact_user, process.exact_system))
+            res[wrapper] = {"runs": runs, "real": sum([v[0] for v in values]) / runs, "user": sum([v[1] for v in values]) / runs, "system": sum([v[2] for v in values]) / runs, "date": time.strftime("%c")}
+        data = self._read()
+        data[self.host] = res
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename + ".tmp", "w") as f:
+            json.dump(data, f, indent=1)
+        os.replace(self.filename + ".tmp", self.filename)
+        return res
+
+Slot = collections.namedtuple("Slot", ["index", "cpus", "node"])
+
+class Batch:
+    def __init__(self, args):
+        self.args = args
+        self.log = sys.stderr if args.log == None else open(args.log, 'w')
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.running = set()
+        self.interrupted = False
+        self.exit_code = 0
+        self.parser = argumentParser(JobParser)
+
+        with open(args.batch) as f:
+            for (number, line) in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    self.jobs.append(self._parseJob(json.loads(line)))
+                except ValueError as e:
+                    sys.exit("pyrunlim: %s:%d: %s" % (args.batch, number, e))
+
+        self.cpus = sorted(os.sched_getaffinity(0))
+        if args.slots == None:
+            self.slots = [None]
+        else:
+            cpus = self.cpus
+            if args.pyrunlim_affinity != None:
+                cpus = [cpu for cpu in cpus if cpu not in [int(a) for a in args.pyrunlim_affinity.split(",")]]
+            self.slots = Batch._createSlots(args.slots, cpus, numaNodes() if args.numa else None)
+        if args.numa:
+            try:
+                resolveSyscall("set_mempolicy")
+            except OSError as e:
+                sys.exit("pyrunlim: cannot use --numa: %s" % e)
+
+    @staticmethod
+    def _createSlots(count, cpus, nodes):
+        if count < 1 or count > len(cpus):
+            sys.exit("pyrunlim: cannot run %d slots on %d cpus" % (count, len(cpus)))
+        size = len(cpus) // count
+        if nodes:
+            groups = [(node, [cpu for cpu in nodes[node] if cpu in cpus]) for node in sorted(nodes)]
+        else:
+            groups = [(None, cpus)]
+        res = []
+        for (node, group) in groups:
+            for i in range(0, len(group) - size + 1, size):
+                if len(res) < count:
+                    res.append(Slot(len(res), group[i:i+size], node))
+        if len(res) < count:
+            sys.exit("pyrunlim: cannot run %d slots of %d cpus without spanning numa nodes" % (count, size))
+        return res
+
+    def _parseJob(self, job):
+        # keys are checked and converted as the long options they are named after
+        if not isinstance(job, dict):
+            raise ValueError("job must be a JSON object")
+        res = copy.copy(self.args)
+        res.log = None
+        res.regex = None if "regex" in job or self.args.regex == None else list(self.args.regex)
+        argv = []
+        flags = {}
+        for (key, value) in job.items():
+            dest = key.replace("-", "_")
+            if key in ("command", "id"):
+                continue
+            if dest in ("batch", "pyrunlim_affinity", "args", "slots", "numa", "calibrate", "version") or "_" in key or dest not in vars(res):
+                raise ValueError("unknown key '%s'" % key)
+            if isinstance(value, bool):
+                if not isinstance(getattr(self.args, dest), bool):
+                    raise ValueError("argument --%s: expected a value, not %s" % (key, json.dumps(value)))
+                flags[dest] = value
+            elif dest in ("affinity", "regex") and isinstance(value, list):
+                if not all([isinstance(v, int if dest == "affinity" else str) and not isinstance(v, bool) for v in value]):
+                    raise ValueError("argument --%s: invalid list %s" % (key, json.dumps(value)))
+                argv.extend(["--%s=%s" % (key, ",".join([str(v) for v in value]))] if dest == "affinity" else ["--%s=%s" % (key, v) for v in value])
+            elif isinstance(value, (int, float, str)):
+                argv.append("--%s=%s" % (key, value))
+            else:
+                raise ValueError("argument --%s: invalid value %s" % (key, json.dumps(value)))
+        self.parser.parse_args(argv, namespace=res)
+        for (dest, value) in flags.items():
+            setattr(res, dest, value)
+        if "output" in job and "log" not in job:
+            raise ValueError("key 'output' requires key 'log' (jobs sharing the log share its format)")
+        if "affinity" in job and self.args.slots != None:
+            raise ValueError("key 'affinity' conflicts with --slots (each slot has its own cpus)")
+        command = job.get("command")
+        if isinstance(command, list) and command and all([isinstance(arg, str) for arg in command]):
+            (res.command, res.args) = (command[0], command[1:])
+        elif isinstance(command, str):
+            (res.command, res.args) = (command, [])
+        else:
+            raise ValueError("missing command (a string, or a list of strings)")
+        if "id" in job and not isinstance(job["id"], (str, int)):
+            raise ValueError("id must be a string or an integer")
+        res.id = job.get("id")
+        return res
+
+    def run(self):
+        if self.args.output == 'xml':
+            print("<pyrunlim-batch version='%s' jobs='%d' slots='%d'>" % (VERSION, len(self.jobs), len(self.slots)), file=self.log)
+            self.log.flush()
+        self.pending = list(enumerate(self.jobs))
+        workers = [threading.Thread(target=self._worker, args=(slot,)) for slot in self.slots]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if self.args.output == 'xml':
+            print("</pyrunlim-batch>", file=self.log)
+        if self.log != sys.stderr:
+            self.log.close()
+
+    def _worker(self, slot):
+        while True:
+            with self.lock:
+                if self.interrupted or not self.pending:
+                    return
+                (index, job) = self.pending.pop(0)
+                process = Process()
+                self.running.add(process)
+            
+            process.affinity = list(self.cpus)
+            configure(process, job)
+            process.job = str(index + 1) if job.id == None else str(job.id)
+            if process.profile != None and job.profile == self.args.profile:
+                # a profile given for the whole batch is saved in one file per job
+                (root, extension) = os.path.splitext(job.profile)
+                process.profile.filename = "%s-%s%s" % (root, process.job, extension)
+            if process.metricsSocket != None and job.metrics_socket == self.args.metrics_socket and len(self.slots) > 1:
+                # so is a metrics socket given for the whole batch, if jobs run in parallel
+                process.metricsSocket = "%s-%s" % (job.metrics_socket, process.job)
+            # jobs running in parallel can be told apart by their process group, and cannot share stdin
+            process.processGroup = len(self.slots) > 1
+            if slot != None:
+                process.slot = slot.index
+                process.affinity = list(slot.cpus)
+                process.memoryNode = slot.node
+            spool = None
+            if job.log == None:
+                if len(self.slots) > 1:
+                    import tempfile
+                    spool = tempfile.TemporaryFile("w+")
+                    process.log = spool
+                else:
+                    process.log = self.log
+            process.run()
+
+            with self.lock:
+                self.running.discard(process)
+                self.exit_code = max(self.exit_code, process.exit_code)
+                if spool != None:
+                    spool.seek(0)
+                    import shutil
+                    shutil.copyfileobj(spool, self.log)
+                    self.log.flush()
+                    spool.close()
+
+    def kill(self):
+        with self.lock:
+            self.interrupted = True
+            running = list(self.running)
+        for process in running:
+            process.kill()
+
 if __name__ == "__main__":
-    process = Process()
-    parseArguments(process)
+    args = parseArguments()
+    if args.calibrate != None:
+        calibration = Calibration(args.calibration_file if args.calibration_file != None else defaultCalibrationFile())
+        for (wrapper, values) in calibration.measure(args.calibrate).items():
+            print("[pyrunlim] %s cost:\treal %.3f, user %.3f, system %.3f seconds (average of %d runs)" % (wrapper, values["real"], values["user"], values["system"], values["runs"]), file=sys.stderr)
+        for wrapper in ("bash", "direct"):
+            values = calibration.load(wrapper)
+            print("[pyrunlim] %s overhead:\treal %.3f, user %.3f, system %.3f seconds" % (wrapper, values["real"], values["user"], values["system"]), file=sys.stderr)
+        print("[pyrunlim] saved in %s" % calibration.filename, file=sys.stderr)
+        sys.exit(0)
+    if args.batch != None:
+        process = Batch(args)
+    else:
+        process = Process()
+        configure(process, args)
+    if args.pyrunlim_affinity != None:
+        setPyrunlimAffinity([int(a) for a in args.pyrunlim_affinity.split(",")])
     
     def signal_handler(signal, frame):
         process.kill()
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import logreader
+
+DIRNAME = os.path.dirname(os.path.abspath(__file__))
+
+# values measured by pyrunlim differ from run to run: only their type is compared
+MEASURED = ["start", "end", "real", "time", "user", "system", "memory", "exact-time", "exact-user", "exact-system", "exact-memory", "children", "reaped", "samples", "sample", "time-overshoot", "memory-overshoot", "sampling-overhead", "sampling-cpu-overhead"]
+
+class TestFormats(unittest.TestCase):
+    def records(self, output):
+        # the log is written to a file, apart from the streams of the command
+        with tempfile.TemporaryDirectory() as directory:
+            log = os.path.join(directory, "log")
+            subprocess.check_call([sys.executable, os.path.join(DIRNAME, "pyrunlim.py"), "--output=%s" % output, "--log=%s" % log, "--time=5", "--regex=(?P<word>h.)", "--redirect-output=/dev/null", "--redirect-error=/dev/null", "sh", "-c", "echo hi; echo ho 1>/dev/stderr"])
+            with open(log) as f:
+                return list(logreader.records(f))
+
+    def test_same_records(self):
+        xml = self.records("xml")
+        jsonl = self.records("jsonl")
+        self.assertEqual([record["type"] for record in xml], [record["type"] for record in jsonl])
+        for (x, j) in zip(xml, jsonl):
+            self.assertEqual(sorted(x.keys()), sorted(j.keys()), x["type"])
+            for key in x:
+                self.assertIs(type(x[key]), type(j[key]), "%s %s" % (x["type"], key))
+                if key not in MEASURED:
+                    self.assertEqual(x[key], j[key], "%s %s" % (x["type"], key))
+
+    def test_missing_limits(self):
+        for output in ("xml", "jsonl"):
+            begin = self.records(output)[0]
+            self.assertEqual(begin["time-limit"], 5)
+            self.assertIsNone(begin["memory-limit"])
+
+if __name__ == "__main__":
+    unittest.main()
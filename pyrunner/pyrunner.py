@@ -21,15 +21,21 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 VERSION = "1.5"
 
 import argparse
+import concurrent.futures
 import fileinput
+import heapq
 from lxml import etree
+import queue
 import re
+import signal
 import subprocess
 import sys
+import threading
 import time
 import os
 
 from output import *
+from store import *
 from validator import *
 
 dirname = os.path.dirname(__file__)
@@ -42,10 +48,17 @@ def parseArguments(runner):
     parser.add_argument('-r', '--run', metavar='<filename>', action='append', help='python code defining benchmarks and commands (use this flag for each file to be run)')
     parser.add_argument('-l', '--log', metavar='<filename>', type=str, help='save log to <filename> (default STDERR)')
     parser.add_argument('-o', '--output', metavar='<output>', type=str, choices=['text', 'xml'], default='text', help='output format (text or xml; default is text)')
+    parser.add_argument('-j', '--jobs', metavar='<integer>', type=int, default=1, help='run up to <integer> commands in parallel, each one pinned to its own share of the available cpus (default is 1; --affinity in pyrunlim arguments is an error with more jobs); dependencies and stopAfterFirstFailure are honoured, and the report is in the usual order. Validators run on the cpus left over by the split, if any (e.g., cpu 6 and 7 for 8 cpus and 3 jobs); otherwise they share the cpus of the commands and may slow them down, unless <integer> is chosen so that some cpus are left over')
+    parser.add_argument('--store', metavar='<filename>', type=str, help='keep the result of each run in the SQLite database <filename>, keyed by the hash of pyrunlim arguments, command line and content of testcase files; runs already in <filename> are not run again, and their result is reported as it was')
+    parser.add_argument('--rerun-failed', action='store_true', help='run again the runs in --store that did not complete (e.g., out of time or memory); requires --store')
+    parser.add_argument('--table', metavar='<filename>', type=str, help='add a row for each run (benchmark, testcase, command, status, time, memory, validator, regex matches) to table results of the SQLite database <filename>, to be queried by means of "pyrunner.py query"')
+    parser.add_argument('--spill', action='store_true', help='save the complete pyrunlim record of each run in the output directory (the report keeps only stats and streams with regex matches)')
     parser.add_argument('-d', '--output-directory', metavar='<output-directory>', type=str, default='.', help='directory for storing output files (default is .)')
     parser.add_argument('-f', '--fix-xml', metavar='<filename>', type=str, help="fix unclosed tags in xml file (and exit)")
     parser.add_argument('-s', '--split-xml', metavar='<filename,count>', type=str, help="split the passed file into blocks of 'count' elements (and exit)")
     args = parser.parse_args()
+    if args.rerun_failed and args.store == None:
+        parser.error("--rerun-failed requires --store")
     
     if args.run != None:
         runner.runfiles = args.run
@@ -58,6 +71,14 @@ def parseArguments(runner):
             runner.output = XmlOutput(runner)
     if args.output_directory != None:
         runner.outputDirectory = args.output_directory
+    if args.jobs != None:
+        runner.jobs = args.jobs
+    if args.store != None:
+        runner.store = ResultStore(args.store)
+    runner.rerunFailed = args.rerun_failed
+    runner.spill = args.spill
+    if args.table != None:
+        runner.table = ResultTable(args.table)
     if args.fix_xml != None:
         runner.fixXml(args.fix_xml)
     if args.split_xml != None:
@@ -119,6 +140,26 @@ class Benchmark:
     def hasToSkip(self, command):
         return self.stopped is not None and command.id in self.stopped
 
+class Run:
+    def __init__(self, position, benchmark, testcase, command, completeCommand):
+        self.position = position
+        self.benchmark = benchmark
+        self.testcase = testcase
+        self.command = command
+        self.completeCommand = completeCommand
+        self.predecessors = set()
+        self.successors = []
+        self.done = False
+        self.skipped = False
+        self.key = None
+        self.xml = None
+        self.response = None
+        self.error = None
+
+    def after(self, run):
+        self.predecessors.add(run)
+        run.successors.append(self)
+
 class Runner:
     def __init__(self, pyrunlim=[]):
         global dirname
@@ -132,6 +173,15 @@ class Runner:
         self.log = sys.stderr
         self.output = XmlOutput(self)
         self.outputDirectory = '.'
+        self.jobs = 1
+        self.store = None
+        self.rerunFailed = False
+        self.spill = False
+        self.table = None
+        self.validatorCpus = None
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.aborting = False
         
     def setPyrunlim(self, value):
         self.pyrunlim = [s.replace("$DIRNAME", dirname) for s in value]
@@ -177,54 +227,276 @@ class Runner:
             os.makedirs(self.outputDirectory)
 
         self._replaceDirname()
+        slots = self._createSlots()
+        if slots != [None] and [arg for arg in self.pyrunlim if re.match(r"-a|--af", arg)]:
+            sys.exit("Cannot run %d jobs with --affinity in pyrunlim arguments (each job is pinned to its own cpus)" % self.jobs)
         self.output.begin()
-        time_str = time.strftime(".%Y-%m-%d_%H-%M-%S", time.gmtime(self.beginTime))
-        counter = 0
-        for benchmark in self.benchmarksOrder:
-            self.output.beginBenchmark(benchmark)
-            for testcase in benchmark.testcases:
-                self.output.beginTestcase(testcase)
-                for command in self.commandsOrder:
-                    completeCommand = command.command
-                    for i in range(len(testcase), 0, -1):
-                        completeCommand = completeCommand.replace("$%d" % (len(benchmark.sharedOptions)+i), testcase[i-1])
-                    for i in range(len(benchmark.sharedOptions), 0, -1):
-                        completeCommand = completeCommand.replace("$%d" % i, benchmark.sharedOptions[i-1])
-                    self.output.beginCommand(command)
-                    
-                    if benchmark.hasToSkip(command) or command.hasToSkip(benchmark, testcase):
-                        self.output.skip()
-                    else:
-                        args = list(self.pyrunlim)
-                        counter = counter + 1
-                        args.append("--redirect-output=%s/%s_%05d_OUT_%s" % (self.outputDirectory, time_str, counter, command.id))
-                        args.append("--redirect-error=%s/%s_%05d_ERR_%s" % (self.outputDirectory, time_str, counter, command.id))
-                        args.append(completeCommand)
-                        proc = subprocess.Popen(args, stderr=subprocess.PIPE)
-                        (out, err) = proc.communicate()
-                        xml = etree.XML(err.decode())
-
-                        self.output.report(xml)
-                        if  xml.xpath("//stats/@status != 'complete'"):
-                            benchmark.onInvalidRun(testcase, command)
-                            command.onInvalidRun(benchmark, testcase)
-                            self.output.onIncompleteRun()
-                        elif command.validator.valid(command, benchmark, testcase, xml) and benchmark.validator.valid(command, benchmark, testcase, xml):
-                            benchmark.onValidRun(testcase, command)
-                            command.onValidRun(benchmark, testcase)
-                            self.output.onValidRun()
-                        else:
-                            benchmark.onInvalidRun(testcase, command)
-                            command.onInvalidRun(benchmark, testcase)
-                            self.output.onInvalidRun()
-                        
-                    self.output.endCommand(command)
-                self.output.endTestcase(testcase)
-            self.output.endBenchmark(benchmark)
+        self.timeStr = time.strftime(".%Y-%m-%d_%H-%M-%S", time.gmtime(self.beginTime))
+        self.counter = 0
+        (plan, runs) = self._plan()
+        cache = ValidationCache(self.store)
+        for item in list(self.benchmarksOrder) + list(self.commandsOrder):
+            if hasattr(item.validator, "setCache"):
+                item.validator.setCache(cache)
+
+        # runs are dispatched as soon as the runs they depend on are processed, and reported in order;
+        # validators are run by a separate pool, so that slots are given to the next runs meanwhile
+        ready = [run.position for run in runs if not run.predecessors]
+        heapq.heapify(ready)
+        results = queue.Queue()
+        validators = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.jobs), initializer=self._pinValidator)
+        running = 0
+        emitted = 0
+        while True:
+            while ready:
+                run = runs[ready[0]]
+                if run.benchmark.hasToSkip(run.command) or run.command.hasToSkip(run.benchmark, run.testcase):
+                    heapq.heappop(ready)
+                    run.skipped = True
+                    self._processed(run, ready)
+                    continue
+                if self.store != None and self._replay(run):
+                    heapq.heappop(ready)
+                    running = running + self._validate(run, ready, validators, results)
+                    continue
+                if not slots:
+                    break
+                heapq.heappop(ready)
+                self._dispatch(run, slots.pop(0), results)
+                running = running + 1
+            emitted = self._emit(plan, emitted)
+            if running == 0:
+                break
+            (event, run, slot) = results.get()
+            running = running - 1
+            if run.error != None:
+                self._abort(running, results, validators)
+                raise run.error
+            if event == "validated":
+                self._record(run, ready)
+                continue
+            slots.append(slot)
+            if self.store != None:
+                self.store.put(run.key, run.benchmark, run.testcase, run.command, run.xml.xpath("string(//stats/@status)"), etree.tostring(run.xml).decode())
+            running = running + self._validate(run, ready, validators, results)
+
+        validators.shutdown()
 
         self.output.end()
+        if self.store != None:
+            self.store.close()
+        if self.table != None:
+            self.table.close()
         if self.log != sys.stderr:
             self.log.close()
+
+    def _replay(self, run):
+        run.key = self.store.key(self.pyrunlim, run.benchmark, run.testcase, run.completeCommand)
+        row = self.store.get(run.key)
+        if row == None or (self.rerunFailed and row[0] != "complete"):
+            return False
+        run.xml = etree.XML(row[1])
+        return True
+
+    def _createSlots(self):
+        # the cpus not handed out to slots are left to validators
+        if self.jobs == 1:
+            return [None]
+        cpus = sorted(os.sched_getaffinity(0))
+        if self.jobs < 1 or self.jobs > len(cpus):
+            sys.exit("Cannot run %d jobs on %d cpus" % (self.jobs, len(cpus)))
+        size = len(cpus) // self.jobs
+        if self.jobs * size < len(cpus):
+            self.validatorCpus = cpus[self.jobs * size:]
+        return [",".join([str(cpu) for cpu in cpus[i * size:(i + 1) * size]]) for i in range(self.jobs)]
+
+    def _pinValidator(self):
+        # the affinity of a thread is inherited by the processes it starts (e.g., checkers of AspCompetitionValidator)
+        if self.validatorCpus != None:
+            os.sched_setaffinity(0, self.validatorCpus)
+
+    def _completeCommand(self, benchmark, testcase, command):
+        completeCommand = command.command
+        for i in range(len(testcase), 0, -1):
+            completeCommand = completeCommand.replace("$%d" % (len(benchmark.sharedOptions)+i), testcase[i-1])
+        for i in range(len(benchmark.sharedOptions), 0, -1):
+            completeCommand = completeCommand.replace("$%d" % i, benchmark.sharedOptions[i-1])
+        return completeCommand
+
+    def _plan(self):
+        plan = []
+        runs = []
+        index = {}
+        for benchmark in self.benchmarksOrder:
+            plan.append(("beginBenchmark", benchmark))
+            for (position, testcase) in enumerate(benchmark.testcases):
+                plan.append(("beginTestcase", testcase))
+                for command in self.commandsOrder:
+                    run = Run(len(runs), benchmark, testcase, command, self._completeCommand(benchmark, testcase, command))
+                    index[(benchmark.id, position, command.id)] = run
+                    runs.append(run)
+                    plan.append(("beginCommand", run))
+                    plan.append(("result", run))
+                    plan.append(("endCommand", run))
+                plan.append(("endTestcase", testcase))
+            plan.append(("endBenchmark", benchmark))
+
+        # a run waits for the runs whose outcome is checked by hasToSkip, and a dependency coming later
+        # waits for the run depending on it (so that the run is skipped, as when running sequentially)
+        for benchmark in self.benchmarksOrder:
+            for position in range(len(benchmark.testcases)):
+                for command in self.commandsOrder:
+                    run = index[(benchmark.id, position, command.id)]
+                    for dependency in command.dependencies:
+                        other = index.get((benchmark.id, position, dependency))
+                        if other == None:
+                            continue
+                        if other.position < run.position:
+                            run.after(other)
+                        else:
+                            other.after(run)
+                    if benchmark.stopped is not None and position > 0:
+                        run.after(index[(benchmark.id, position - 1, command.id)])
+        return (plan, runs)
+
+    def _dispatch(self, run, slot, results):
+        args = list(self.pyrunlim)
+        self.counter = self.counter + 1
+        if slot != None:
+            args.append("--affinity=%s" % slot)
+        args.append("--redirect-output=%s/%s_%05d_OUT_%s" % (self.outputDirectory, self.timeStr, self.counter, run.command.id))
+        args.append("--redirect-error=%s/%s_%05d_ERR_%s" % (self.outputDirectory, self.timeStr, self.counter, run.command.id))
+        args.append(run.completeCommand)
+        spill = "%s/%s_%05d_XML_%s" % (self.outputDirectory, self.timeStr, self.counter, run.command.id) if self.spill else None
+        threading.Thread(target=self._execute, args=(run, args, spill, slot, results), daemon=True).start()
+
+    def _execute(self, run, args, spill, slot, results):
+        try:
+            proc = subprocess.Popen(args, stderr=subprocess.PIPE)
+            with self.lock:
+                self.processes.add(proc)
+                if self.aborting:
+                    proc.send_signal(signal.SIGINT)
+            try:
+                run.xml = self._parse(proc.stderr, spill)
+                proc.wait()
+            finally:
+                with self.lock:
+                    self.processes.discard(proc)
+        except Exception as e:
+            run.error = e
+        results.put(("executed", run, slot))
+
+    def _abort(self, running, results, validators):
+        # pyrunlim stops its command on SIGINT: runs still in progress are interrupted and waited for,
+        # so that no command is left running after pyrunner
+        with self.lock:
+            self.aborting = True
+            for proc in self.processes:
+                proc.send_signal(signal.SIGINT)
+        for i in range(running):
+            results.get()
+        validators.shutdown()
+
+    def _drop(self, element):
+        element.tail = None
+        element.getparent().remove(element)
+
+    def _parse(self, stream, spill):
+        # samples and streams without regex matches are dropped while parsing, so that memory
+        # usage does not depend on the output of the command; logreader is not used here because
+        # validators and the output of pyrunner need the (lxml) element itself, not its records
+        parser = etree.XMLPullParser(events=("start", "end"))
+        spillFile = open(spill, "wb") if spill != None else None
+        root = None
+        for data in iter(lambda: stream.read1(65536), b""):
+            if spillFile != None:
+                spillFile.write(data)
+            parser.feed(data)
+            for (event, element) in parser.read_events():
+                if root is None:
+                    root = element
+                if event == "start" or element.getparent() is not root:
+                    continue
+                # the text following dropped elements is appended to the previous one
+                previous = element.getprevious()
+                if previous is None:
+                    root.text = "\n"
+                else:
+                    previous.tail = "\n"
+                if element.tag == "sample":
+                    self._drop(element)
+                elif element.tag == "stream":
+                    for child in list(element):
+                        if child.tag != "match":
+                            self._drop(child)
+                    if len(element) == 0:
+                        self._drop(element)
+        if spillFile != None:
+            spillFile.close()
+        xml = parser.close()
+        if spill != None:
+            xml.set("spill", spill)
+        return xml
+
+    def _validate(self, run, ready, validators, results):
+        # returns the number of validations left pending
+        if  run.xml.xpath("//stats/@status != 'complete'"):
+            run.response = "n/a"
+            self._record(run, ready)
+            return 0
+        validators.submit(self._check, run, results)
+        return 1
+
+    def _check(self, run, results):
+        (benchmark, testcase, command, xml) = (run.benchmark, run.testcase, run.command, run.xml)
+        try:
+            run.response = "yes" if command.validator.valid(command, benchmark, testcase, xml) and benchmark.validator.valid(command, benchmark, testcase, xml) else "no"
+        except Exception as e:
+            run.error = e
+        results.put(("validated", run, None))
+
+    def _record(self, run, ready):
+        if run.response == "yes":
+            run.benchmark.onValidRun(run.testcase, run.command)
+            run.command.onValidRun(run.benchmark, run.testcase)
+        else:
+            run.benchmark.onInvalidRun(run.testcase, run.command)
+            run.command.onInvalidRun(run.benchmark, run.testcase)
+        self._processed(run, ready)
+
+    def _processed(self, run, ready):
+        run.done = True
+        for successor in run.successors:
+            successor.predecessors.discard(run)
+            if not successor.predecessors:
+                heapq.heappush(ready, successor.position)
+
+    def _emit(self, plan, emitted):
+        while emitted < len(plan):
+            (event, item) = plan[emitted]
+            if event == "result":
+                if not item.done:
+                    break
+                if self.table != None:
+                    self.table.add(item.benchmark, item.testcase, item.command, item.xml, item.response)
+                if item.skipped:
+                    self.output.skip()
+                else:
+                    self.output.report(item.xml)
+                    if item.response == "n/a":
+                        self.output.onIncompleteRun()
+                    elif item.response == "yes":
+                        self.output.onValidRun()
+                    else:
+                        self.output.onInvalidRun()
+                    item.xml = None
+            elif event in ("beginCommand", "endCommand"):
+                getattr(self.output, event)(item.command)
+            else:
+                getattr(self.output, event)(item)
+            emitted = emitted + 1
+        return emitted
             
     def fixXml(self, filename):
         tags = []
@@ -286,6 +558,10 @@ class Runner:
         exit(0)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        from query import query
+        query(sys.argv[2:])
+        sys.exit(0)
     runner = Runner()
     parseArguments(runner)
 
@@ -0,0 +1,56 @@
+import argparse
+import sqlite3
+import sys
+import urllib.parse
+
+# the last run of each benchmark, testcase and command (runs may be repeated, e.g., by --rerun-failed)
+LATEST = "WITH latest AS (SELECT * FROM results WHERE id IN (SELECT MAX(id) FROM results GROUP BY benchmark, testcase, command))"
+SOLVED = "(status = 'complete' AND validator = 'yes')"
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog="pyrunner.py query", description="Aggregate the results table written by pyrunner.py --table (tab-separated output).")
+    parser.add_argument('report', metavar='<report>', type=str, choices=['pivot', 'cactus', 'par2'], help='pivot (one row per testcase, one column per command), cactus (solved testcases of each command sorted by time) or par2 (solved testcases and penalized average time of each command)')
+    parser.add_argument('table', metavar='<filename>', type=str, help='SQLite database written by pyrunner.py --table')
+    parser.add_argument('--value', metavar='<value>', type=str, choices=['time', 'memory', 'real'], default='time', help='value reported by pivot and cactus: time, memory or real (default is time)')
+    parser.add_argument('--time-limit', metavar='<float>', type=float, help='time limit used by par2 (default is the time limit of each run, or the largest one for runs without time limit)')
+    parser.add_argument('--by-benchmark', action='store_true', help='aggregate cactus and par2 by benchmark and command')
+    return parser.parse_args(argv)
+
+def commands(connection):
+    return [row[0] for row in connection.execute("%s SELECT command FROM latest GROUP BY command ORDER BY MIN(id)" % LATEST)]
+
+def pivot(connection, args):
+    names = commands(connection)
+    columns = ", ".join(["MAX(CASE WHEN command = ? THEN CASE WHEN %s THEN printf('%%.2f', %s) ELSE 'n/a' END END)" % (SOLVED, args.value) for name in names])
+    yield ["benchmark", "testcase"] + names
+    for row in connection.execute("%s SELECT benchmark, testcase, %s FROM latest GROUP BY benchmark, testcase ORDER BY MIN(id)" % (LATEST, columns), names):
+        yield ["-" if value == None else value for value in row]
+
+def cactus(connection, args):
+    group = "benchmark, command" if args.by_benchmark else "command"
+    yield group.split(", ") + ["solved", args.value, "cumulative"]
+    yield from connection.execute("%s SELECT %s, ROW_NUMBER() OVER w AS solved, printf('%%.2f', %s), printf('%%.2f', SUM(%s) OVER w) FROM latest WHERE %s WINDOW w AS (PARTITION BY %s ORDER BY %s, id) ORDER BY %s, solved" % (LATEST, group, args.value, args.value, SOLVED, group, args.value, group))
+
+# tables written by previous versions store missing limits as 1e100 rather than NULL
+TIME_LIMIT = "(CASE WHEN time_limit < 1e100 THEN time_limit END)"
+
+def par2(connection, args):
+    # unsolved runs (including skipped ones) count as twice the time limit
+    group = "benchmark, command" if args.by_benchmark else "command"
+    if args.time_limit == None and connection.execute("%s SELECT MAX(%s) FROM latest" % (LATEST, TIME_LIMIT)).fetchone()[0] == None:
+        sys.exit("pyrunner.py query: %s: runs have no time limit, use --time-limit" % args.table)
+    limit = "COALESCE(?, %s, (SELECT MAX(%s) FROM latest))" % (TIME_LIMIT, TIME_LIMIT)
+    yield group.split(", ") + ["runs", "solved", "par2", "solved-time"]
+    yield from connection.execute("%s SELECT %s, COUNT(*), SUM(%s), printf('%%.2f', AVG(CASE WHEN %s THEN time ELSE 2 * %s END)), printf('%%.2f', TOTAL(CASE WHEN %s THEN time END)) FROM latest GROUP BY %s ORDER BY MIN(id)" % (LATEST, group, SOLVED, SOLVED, limit, SOLVED, group), (args.time_limit,))
+
+def query(argv):
+    args = parseArguments(argv)
+    try:
+        connection = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(args.table), uri=True)
+        try:
+            for row in {"pivot": pivot, "cactus": cactus, "par2": par2}[args.report](connection, args):
+                print("\t".join([str(value) for value in row]))
+        finally:
+            connection.close()
+    except sqlite3.OperationalError as e:
+        sys.exit("pyrunner.py query: %s: %s" % (args.table, e))
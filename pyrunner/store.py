@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+def fileHash(filename):
+    hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hash.update(block)
+    return hash.hexdigest()
+
+def limit(value):
+    # missing limits are written by pyrunlim as 10**100, and stored as NULL
+    value = float(value)
+    return value if value < 10**100 else None
+
+class ResultStore:
+    def __init__(self, filename):
+        # validations are stored by worker threads
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, benchmark TEXT, testcase TEXT, command TEXT, status TEXT, xml TEXT, date TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS validations (key TEXT PRIMARY KEY, verdict INTEGER)")
+        self.connection.commit()
+        self.hashes = {}
+
+    def close(self):
+        self.connection.close()
+
+    def _fileHash(self, filename):
+        if filename not in self.hashes:
+            self.hashes[filename] = fileHash(filename)
+        return self.hashes[filename]
+
+    def key(self, pyrunlim, benchmark, testcase, completeCommand):
+        files = [self._fileHash(item) if os.path.isfile(item) else None for item in list(benchmark.sharedOptions) + list(testcase)]
+        return hashlib.sha256(json.dumps([pyrunlim, completeCommand, files]).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            return self.connection.execute("SELECT status, xml FROM runs WHERE key = ?", (key,)).fetchone()
+
+    def put(self, key, benchmark, testcase, command, status, xml):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)", (key, benchmark.id, str(testcase), command.id, status, xml, time.strftime("%c")))
+            self.connection.commit()
+
+    def getValidation(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT verdict FROM validations WHERE key = ?", (key,)).fetchone()
+        return None if row == None else bool(row[0])
+
+    def putValidation(self, key, verdict):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO validations VALUES (?, ?)", (key, int(verdict)))
+            self.connection.commit()
+
+class ValidationCache:
+    def __init__(self, store=None):
+        self.store = store
+        self.verdicts = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def key(self, validator, testcase, outputHash):
+        with self.lock:
+            if testcase not in self.hashes:
+                self.hashes[testcase] = fileHash(testcase)
+            hash = self.hashes[testcase]
+        return hashlib.sha256(json.dumps([validator, hash, outputHash]).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.verdicts and self.store != None:
+                verdict = self.store.getValidation(key)
+                if verdict != None:
+                    self.verdicts[key] = verdict
+            return self.verdicts.get(key)
+
+    def put(self, key, verdict):
+        with self.lock:
+            self.verdicts[key] = verdict
+            if self.store != None:
+                self.store.putValidation(key, verdict)
+
+class ResultTable:
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, benchmark TEXT, testcase TEXT, command TEXT, status TEXT, result INTEGER, time REAL, memory REAL, real REAL, time_limit REAL, memory_limit REAL, validator TEXT, matches TEXT)")
+        self.connection.commit()
+        self.session = time.strftime("%c")
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, benchmark, testcase, command, xml, response):
+        if xml is None:
+            row = ("skip", None, None, None, None, None, None, None, None)
+        else:
+            stats = xml.find("stats")
+            matches = [{"regex": match.findtext("regex"), "groups": {group.get("name"): group.text for group in match.findall("group")}} for match in xml.iter("match")]
+            row = (stats.get("status"), int(stats.get("result")), float(stats.get("time")), float(stats.get("memory")), float(stats.get("real")), limit(xml.get("time-limit")), limit(xml.get("memory-limit")), response, json.dumps(matches))
+        self.connection.execute("INSERT INTO results (session, benchmark, testcase, command, status, result, time, memory, real, time_limit, memory_limit, validator, matches) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (self.session, benchmark.id, str(testcase), command.id) + row)
+        self.connection.commit()
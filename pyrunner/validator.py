@@ -1,4 +1,5 @@
 import fileinput
+import hashlib
 from lxml import etree
 import re
 import subprocess
@@ -6,6 +7,8 @@ import sys
 import time
 import os
 
+from store import ValidationCache
+
 class AllValidator:
     def valid(self, command, benchmark, testcase, xml):
         return True
@@ -13,6 +16,9 @@ class AllValidator:
     def setDirname(self, dirname):
         pass
 
+    def setCache(self, cache):
+        pass
+
 class ExitCodeValidator:
     def __init__(self, validExitCodes=[0]):
         self.validExitCodes = validExitCodes
@@ -23,17 +29,67 @@ class ExitCodeValidator:
     def setDirname(self, dirname):
         pass
 
+    def setCache(self, cache):
+        pass
+
 class AspCompetitionValidator:
     def __init__(self, path):
         self.path = path
+        self.cache = ValidationCache()
         
     def valid(self, command, benchmark, testcase, xml):
         output_file = xml.xpath("//stats/@output")[0]
         try:
-            lines = subprocess.check_output(["bash", "-c", "(cat %s; tail --lines=1 %s) | sed 's/^\[[^]]*\] //' | %s" % (testcase[0], output_file, self.path)])
-            return lines.decode().strip() == "OK"
-        except:
+            # verdicts depend only on the testcase and on the last line of the output (without timestamp)
+            key = self.cache.key(self.path, testcase[0], lastLineHash(output_file))
+            verdict = self.cache.get(key)
+            if verdict == None:
+                lines = subprocess.check_output(["bash", "-c", "(cat %s; tail --lines=1 %s) | sed 's/^\[[^]]*\] //' | %s" % (testcase[0], output_file, self.path)])
+                verdict = lines.decode(errors="replace").strip() == "OK"
+                self.cache.put(key, verdict)
+            return verdict
+        except (subprocess.CalledProcessError, OSError):
             return False
 
     def setDirname(self, dirname):
         self.path = self.path.replace("$DIRNAME", dirname)
+
+    def setCache(self, cache):
+        self.cache = cache
+
+def lastLineHash(filename, size=1 << 20):
+    # the hash of the last line (as tail --lines=1) without timestamp, read block by block: the
+    # output of a solver may be a single line of gigabytes
+    hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        offset = lastLineOffset(f)
+        f.seek(offset)
+        f.seek(offset + timestampLength(f, size))
+        for block in iter(lambda: f.read(size), b""):
+            hash.update(block)
+    return hash.hexdigest()
+
+def timestampLength(f, size=65536):
+    # the length of the prefix removed by sed 's/^\[[^]]*\] //' at the current position, or 0
+    start = f.tell()
+    if f.read(1) != b"[":
+        return 0
+    for block in iter(lambda: f.read(size), b""):
+        index = block.find(b"]")
+        if index != -1:
+            end = f.tell() - len(block) + index + 1
+            f.seek(end)
+            return end + 1 - start if f.read(1) == b" " else 0
+    return 0
+
+def lastLineOffset(f, size=65536):
+    # the final newline belongs to the last line
+    position = max(0, f.seek(0, os.SEEK_END) - 1)
+    while position > 0:
+        start = max(0, position - size)
+        f.seek(start)
+        index = f.read(position - start).rfind(b"\n")
+        if index != -1:
+            return start + index + 1
+        position = start
+    return 0